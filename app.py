@@ -1,15 +1,39 @@
-from fastapi import Request, FastAPI
+from contextlib import asynccontextmanager
+from fastapi import Request, FastAPI, Depends
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
-from config import templates, verify_jwt, usersdb, chatsdb
+from config import templates, verify_jwt, AI_WORKER_IN_PROCESS, ensure_indexes
 from core.admin import adminrouter
 from core.api import apirouter
-from core.chat import chatrouter
+from core.chat import chatrouter, COMPLETION_TIMEOUT_SECONDS
+from core.session import Session, get_session
+from core import llm, chat, matchmaking, leaderboard
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        print(f"Error creating indexes: {e}")
+    llm.open_http_client(COMPLETION_TIMEOUT_SECONDS)
+    await leaderboard.start()
+    chat.start_room_tasks()
+    matchmaking.start()
+    if AI_WORKER_IN_PROCESS:
+        chat.start_ai_worker()
+    yield
+    await matchmaking.stop()
+    await leaderboard.stop()
+    await chat.stop_ai_worker()
+    await chat.stop_room_tasks()
+    await llm.close_http_client()
 
 app = FastAPI(
     docs_url=None,
     redoc_url=None,
     title="Reverse Turing",
+    lifespan=lifespan,
 )
 app.include_router(adminrouter)
 app.include_router(apirouter)
@@ -18,44 +42,24 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
-    token = request.cookies.get("token")
-    if token:
-        data = verify_jwt(token)
-        if data:
-            if data["type"] == "user":
-                activeroom = await chatsdb.find_one({"active": True, "$or": [
-                        {"user1": data["username"]},
-                        {"user2": data["username"]}
-                    ]
-                })
-                if activeroom:
-                    user = await usersdb.find_one({"_id": data["username"]})
-                    if user and activeroom["_id"] in user.get("judged", []):
-                        return RedirectResponse(url="/dashboard")
-                    return RedirectResponse(url="/chat/{}".format(activeroom["_id"]))
-                return RedirectResponse(url="/dashboard")
-            elif data["type"] == "admin":
-                return RedirectResponse(url="/admin/dashboard")
+async def home(request: Request, session: Session = Depends(get_session)):
+    if session:
+        if session.type == "user":
+            if session.unjudged_room:
+                return RedirectResponse(url="/chat/{}".format(session.unjudged_room))
+            return RedirectResponse(url="/dashboard")
+        elif session.type == "admin":
+            return RedirectResponse(url="/admin/dashboard")
     return RedirectResponse(url="/login")
 
 @app.get("/login", response_class=HTMLResponse)
-async def login(request: Request):
-    token = request.cookies.get("token")
-    if token:
-        data = verify_jwt(token)
-        if data:
-            if data["type"] == "user":
-                activeroom = await chatsdb.find_one({"active": True, "$or": [
-                        {"user1": data["username"]},
-                        {"user2": data["username"]}
-                    ]
-                })
-                if activeroom:
-                    user = await usersdb.find_one({"_id": data["username"]})
-                    if user and activeroom["_id"] in user.get("judged", []):
-                        return RedirectResponse(url="/leaderboard")
-                    return RedirectResponse(url="/chat/{}".format(activeroom["_id"]))
+async def login(request: Request, session: Session = Depends(get_session)):
+    if session:
+        if session.type == "user":
+            if session.room:
+                if session.judged:
+                    return RedirectResponse(url="/leaderboard")
+                return RedirectResponse(url="/chat/{}".format(session.room))
     return templates.TemplateResponse("login.html", {"request": request})
 
 @app.get("/conclusion", response_class=HTMLResponse)
@@ -72,74 +76,39 @@ async def conclusion(request: Request, verdict: str, title:str):
     )  
 
 @app.get("/leaderboard", response_class=HTMLResponse)
-async def root_leaderboard(request: Request):
-    token = request.cookies.get("token")
-    if token:
-        data = verify_jwt(token)
-        if data:
-            if data["type"] == "user":
-                activeroom = await chatsdb.find_one({"active": True, "$or": [
-                        {"user1": data["username"]},
-                        {"user2": data["username"]}
-                    ]
-                })
-                if activeroom:
-                    user = await usersdb.find_one({"_id": data["username"]})
-                    if not user or activeroom["_id"] not in user.get("judged", []):
-                        return RedirectResponse(url="/chat/{}".format(activeroom["_id"]))
-                
-            leaderboardtemplate = """
+async def root_leaderboard(request: Request, session: Session = Depends(get_session)):
+    if session:
+        if session.type == "user":
+            if session.unjudged_room:
+                return RedirectResponse(url="/chat/{}".format(session.unjudged_room))
+            
+        leaderboardtemplate = """
 <tr class="{bg} text-center text-neongreen text-lg md:text-xl">
     <td class="py-2">{position}</td>
     <td class="py-2">{username}</td>
     <td class="py-2">{score}</td>
 </tr>
 """
-            lb = await usersdb.find({"type": "user", "banned": False}).to_list(length=100)
-            if not lb:
-                return templates.TemplateResponse(
-                    "leaderboard.html",
-                    {
-                        "request": request,
-                        "leaderboard": ""
-                    }
-                )
-            # sorting need to be done twice. First for score and then epoch within score.
-            # Lower epoch with same score comes first.
-            lb = sorted(lb, key=lambda x: x["score"], reverse=True)
-            lbfinal = []
-            temp = []
-            alternativebg = {
-                0: "bg-mattblack",
-                1: "bg-black"
-            }
-            maxscore = lb[0]["score"]
-            for x in lb:
-                if x["score"] == maxscore:
-                    temp.append(x)
-                else:
-                    temp = sorted(temp, key=lambda x: x["lastpoint"])
-                    lbfinal.extend(temp)
-                    temp = [x]
-                    maxscore = x["score"]
-            temp = sorted(temp, key=lambda x: x["lastpoint"])
-            lbfinal.extend(temp)
-            
-            ret = ""
-            for i, x in enumerate(lbfinal):
-                ret += leaderboardtemplate.format(
-                    position=i+1,
-                    username=x["_id"],
-                    score=x["score"],
-                    bg=alternativebg[i%2]
-                )
-            return templates.TemplateResponse(
-                "leaderboard.html",
-                {
-                    "request": request,
-                    "leaderboard": ret
-                }
+        lb = leaderboard.top(100)
+        alternativebg = {
+            0: "bg-mattblack",
+            1: "bg-black"
+        }
+        ret = ""
+        for i, x in enumerate(lb):
+            ret += leaderboardtemplate.format(
+                position=i+1,
+                username=x["username"],
+                score=x["score"],
+                bg=alternativebg[i%2]
             )
+        return templates.TemplateResponse(
+            "leaderboard.html",
+            {
+                "request": request,
+                "leaderboard": ret
+            }
+        )
     return RedirectResponse(url="/")
 
 @app.get("/rules", response_class=HTMLResponse)
@@ -157,55 +126,31 @@ async def rules(request: Request):
     return RedirectResponse(url="/")
 
 @app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request):
-    token = request.cookies.get("token")
-    if token:
-        data = verify_jwt(token)
-        if data:
-            if data["type"] == "user":
-                activeroom = await chatsdb.find_one({"active": True, "$or": [
-                        {"user1": data["username"]},
-                        {"user2": data["username"]}
-                    ]
-                })
-                if activeroom:
-                    user = await usersdb.find_one({"_id": data["username"]})
-                    if user and activeroom["_id"] in user.get("judged", []):
-                        activeroom = None
-                if activeroom:
-                    return RedirectResponse(url="/chat/{0}".format(activeroom["_id"]))
-                return templates.TemplateResponse(
-                    "dashboard.html",
-                    {
-                        "request": request,
-                        "username": data["username"],
-                    }
-                )
+async def dashboard(request: Request, session: Session = Depends(get_session)):
+    if session:
+        if session.type == "user":
+            if session.unjudged_room:
+                return RedirectResponse(url="/chat/{}".format(session.unjudged_room))
+            return templates.TemplateResponse(
+                "dashboard.html",
+                {
+                    "request": request,
+                    "username": session.username,
+                }
+            )
     return RedirectResponse(url="/")
 
 @app.get("/match-making", response_class=HTMLResponse)
-async def match_making(request: Request):
-    token = request.cookies.get("token")
-    if token:
-        data = verify_jwt(token)
-        if data:
-            if data["type"] == "user":
-                activeroom = await chatsdb.find_one({"active": True, "$or": [
-                        {"user1": data["username"]},
-                        {"user2": data["username"]}
-                    ]
-                })
-                if activeroom:
-                    user = await usersdb.find_one({"_id": data["username"]})
-                    if user and activeroom["_id"] in user.get("judged", []):
-                        activeroom = None
-                if activeroom:
-                    return RedirectResponse(url="/chat/{}".format(activeroom["_id"]))
-                return templates.TemplateResponse(
-                    "loading.html",
-                    {
-                        "request": request,
-                        "username": data["username"],
-                    }
-                )
+async def match_making(request: Request, session: Session = Depends(get_session)):
+    if session:
+        if session.type == "user":
+            if session.unjudged_room:
+                return RedirectResponse(url="/chat/{}".format(session.unjudged_room))
+            return templates.TemplateResponse(
+                "loading.html",
+                {
+                    "request": request,
+                    "username": session.username,
+                }
+            )
     return RedirectResponse(url="/")
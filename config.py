@@ -16,6 +16,9 @@ def _get_env(key: str) -> str:
         raise KeyError(key)
     return value
 
+def _get_env_default(key: str, default: str) -> str:
+    return os.getenv(key) or env_data.get(key) or default
+
 mongo_url = _get_env("mongo_url")
 
 client = motor.motor_asyncio.AsyncIOMotorClient(mongo_url)
@@ -24,10 +27,44 @@ usersdb = turingdb["users"]
 chatsdb = turingdb["chats"]
 reportsdb = turingdb["reports"]
 adminlogsdb = turingdb["adminlogs"]
+# AI partition leases and AI worker heartbeats, see core/partitions.py
+partitionsdb = turingdb["partitions"]
+workersdb = turingdb["workers"]
+# single-holder leases, e.g. the matchmaker in core/matchmaking.py
+leasesdb = turingdb["leases"]
 
 jwt_secret = _get_env("jwt_secret")
-APIKEY = _get_env("APIKEY")
-APIKEY1 = _get_env("APIKEY1")
+APIKEY = _get_env_default("APIKEY", "")
+APIKEY1 = _get_env_default("APIKEY1", "")
+# any number of OpenRouter keys, comma separated. APIKEY/APIKEY1 are still read for old creds files
+APIKEYS = [k.strip() for k in _get_env_default("APIKEYS", "").split(",") if k.strip()] or [k for k in (APIKEY, APIKEY1) if k]
+# "openrouter", or "fake" for an in-process provider used in load tests (see core/llm.py)
+LLM_BACKEND = _get_env_default("LLM_BACKEND", "openrouter").lower()
+LLM_URL = _get_env_default("LLM_URL", "https://openrouter.ai/api/v1/chat/completions")
+LLM_MODEL = _get_env_default("LLM_MODEL", "meta-llama/llama-3.3-70b-instruct")
+if not APIKEYS and LLM_BACKEND == "openrouter":
+    raise KeyError("APIKEYS")
+# per-key token bucket: sustained requests per minute and burst size
+APIKEY_RATE_PER_MINUTE = float(_get_env_default("APIKEY_RATE_PER_MINUTE", "200"))
+APIKEY_BURST = int(_get_env_default("APIKEY_BURST", "20"))
+# base cooldown after a 429/5xx when the provider sends no Retry-After, doubles on repeats
+APIKEY_COOLDOWN_SECONDS = float(_get_env_default("APIKEY_COOLDOWN_SECONDS", "5"))
+# needs the h2 package (pip install httpx[http2]), falls back to HTTP/1.1 without it
+LLM_HTTP2 = _get_env_default("LLM_HTTP2", "false").lower() == "true"
+# stream completions and stop reading once the reply passes the word limit
+LLM_STREAMING = _get_env_default("LLM_STREAMING", "false").lower() == "true"
+# fake backend: latency as fixed:<s>, uniform:<min>,<max> or lognormal:<median>,<sigma>,
+# share of calls failing with 429/5xx, optional file of canned replies (one per line)
+FAKE_LLM_LATENCY = _get_env_default("FAKE_LLM_LATENCY", "lognormal:1.5,0.5")
+FAKE_LLM_ERROR_RATE = float(_get_env_default("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_REPLIES = _get_env_default("FAKE_LLM_REPLIES", "")
+FAKE_LLM_SEED = int(_get_env_default("FAKE_LLM_SEED", "0"))
+# AI replies a worker runs at the same time
+AI_WORKER_CONCURRENCY = int(_get_env_default("AI_WORKER_CONCURRENCY", "50"))
+# AI rooms are spread over this many partitions owned by the AI workers, keep it well above the worker count
+AI_PARTITIONS = int(_get_env_default("AI_PARTITIONS", "32"))
+# false when AI replies run in separate `python -m core.worker` processes
+AI_WORKER_IN_PROCESS = _get_env_default("AI_WORKER_IN_PROCESS", "true").lower() == "true"
 
 templates = Jinja2Templates(directory="templates")
 
@@ -67,6 +104,90 @@ async def create_admin(username: str, password: str):
         "banned": False,
     })
 
+# Indexes behind the hot queries. ensure_indexes creates them (idempotent, run at startup),
+# verify_indexes explains HOT_QUERIES and fails when one of them scans a collection.
+INDEXES = {
+    "chats": [
+        # active room of a user, queried as {"active": True, "$or": [{"user1"}, {"user2"}]}
+        ({"user1": 1, "active": 1}, {"name": "user1_active"}),
+        ({"user2": 1, "active": 1}, {"name": "user2_active"}),
+        # AI claims and claim sweeps in core/chat.py
+        ({"partition": 1, "ai_lock_until": 1}, {
+            "name": "ai_claimable",
+            "partialFilterExpression": {"first": "AI", "active": True}
+        }),
+        # overdue turn and guess window sweeps
+        ({"active": 1, "turn_started": 1, "time": 1}, {"name": "active_turn"}),
+        ({"guess_lock_until": 1}, {"name": "guess_lock_until"}),
+        ({"pending_ai.release_at": 1}, {"name": "pending_ai_release"}),
+        # admin chat log, newest first
+        ({"time": -1, "_id": -1}, {"name": "chat_log"}),
+        # moderator transcript search, a collection takes one text index
+        ({"messages.content": "text", "messages.sender": "text", "user1": "text", "user2": "text"}, {
+            "name": "transcripts",
+            "weights": {"messages.content": 1, "messages.sender": 2, "user1": 2, "user2": 2}
+        }),
+    ],
+    "users": [
+        # matchmaker scan in core/matchmaking.py
+        ({"banned": 1, "match_since": 1}, {
+            "name": "queueing",
+            "partialFilterExpression": {"matchmaking": True}
+        }),
+        # leaderboard
+        ({"type": 1, "banned": 1, "score": -1, "lastpoint": 1}, {"name": "leaderboard"}),
+    ],
+}
+
+# (collection, filter, sort) shaped like the queries the app runs
+HOT_QUERIES = [
+    ("chats", {"active": True, "$or": [{"user1": "u"}, {"user2": "u"}]}, None),
+    ("chats", {
+        "active": True, "first": "AI", "pending_ai": {"$exists": False}, "partition": {"$in": [0, 1]},
+        "$or": [{"ai_lock_until": {"$exists": False}}, {"ai_lock_until": {"$lt": datetime.now(IST)}}]
+    }, None),
+    ("chats", {"$or": [
+        {"active": True, "turn_started": {"$lt": 0}},
+        {"active": True, "turn_started": None, "time": {"$lt": 0}},
+        {"guess_lock_until": {"$lt": 0}, "guess_timeout_handled": {"$ne": True}, "user2": {"$ne": "AI"}},
+    ]}, None),
+    ("chats", {"pending_ai.release_at": {"$lt": 0}}, None),
+    ("chats", {"time": {"$gte": 0}}, [("time", -1), ("_id", -1)]),
+    ("chats", {"$text": {"$search": "hello"}}, None),
+    ("users", {"matchmaking": True, "banned": False}, [("match_since", 1)]),
+    ("users", {"type": "user", "banned": False}, [("score", -1), ("lastpoint", 1)]),
+]
+
+
+async def ensure_indexes():
+    for name, indexes in INDEXES.items():
+        for keys, options in indexes:
+            await turingdb[name].create_index(list(keys.items()), **options)
+
+def plan_stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+async def verify_indexes():
+    """Explain every hot query and raise if any of them would scan its collection."""
+    failures = []
+    for name, query, sort in HOT_QUERIES:
+        cursor = turingdb[name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explained = await cursor.explain()
+        if "COLLSCAN" in set(plan_stages(explained["queryPlanner"]["winningPlan"])):
+            failures.append(f"{name}: {query}")
+    if failures:
+        raise RuntimeError("Hot queries without an index:\n" + "\n".join(failures))
+
+
 if __name__ == "__main__":
     import asyncio
     print("""
@@ -74,6 +195,8 @@ if __name__ == "__main__":
 config menu
 -----------
 1. Create Admin.
+2. Create indexes.
+3. Verify indexes.
 5. List Admins.
 
 Enter your choice: """, end="")
@@ -82,3 +205,9 @@ Enter your choice: """, end="")
         username = input("Enter username: ")
         password = input("Enter password: ")
         asyncio.run(create_admin(username, password))
+    elif choice == 2:
+        asyncio.run(ensure_indexes())
+        print("Indexes created.")
+    elif choice == 3:
+        asyncio.run(verify_indexes())
+        print("Every hot query uses an index.")
@@ -4,17 +4,121 @@
 /admin/reports
 /admin/create-user
 /admin/ban
-/admin/chat-logs
+/admin/chat-logs: newest rooms first, ?user=&active=&since=&until= filters, keyset paginated with ?before=
+/admin/search: transcripts ranked by a text search over messages and senders, ?q=&page=
 /admin/chat/{chat_id}
 /admin/admin-logs
+/admin/worker-stats
 """
 
 from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse
 from config import usersdb, chatsdb, templates, verify_jwt, reportsdb, adminlogsdb, IST
+from core.chat import ai_worker_stats, message_sender
 from datetime import datetime
+from urllib.parse import urlencode
+import html
+import re
 
 adminrouter = APIRouter(prefix="/admin", tags=["admin"])
+CHAT_LOG_PAGE_SIZE = 50
+# only what a row shows, messages stay on the server
+CHAT_LOG_FIELDS = {
+    "user1": 1,
+    "user2": 1,
+    "time": 1,
+    "active": 1,
+    "guesses": 1,
+    # rooms from before the counters only have their messages array
+    "message_count": {"$ifNull": ["$message_count", {"$size": {"$ifNull": ["$messages", []]}}]},
+}
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_QUERY = 200
+SNIPPETS_PER_ROOM = 3
+# characters kept either side of the first match in a message
+SNIPPET_CHARS = 60
+SEARCH_FIELDS = {"user1": 1, "user2": 1, "time": 1, "messages": 1, "score": {"$meta": "textScore"}}
+
+
+def parse_admin_time(value: str):
+    """Epoch for a date or datetime-local value entered in IST, None when empty."""
+    if not value:
+        return None
+    return IST.localize(datetime.fromisoformat(value)).timestamp()
+
+def guess_summary(guesses) -> str:
+    parts = []
+    for username, guess in (guesses or {}).items():
+        outcome = "correct" if guess.get("correct") else "wrong"
+        parts.append(f"{username}: {guess.get('guess')} ({outcome})")
+    return ", ".join(parts) or "-"
+
+def rough_stem(word: str) -> str:
+    """Cut a common English suffix so "running" also marks "run" and "runs"; only for highlighting."""
+    word = word.lower()
+    for suffix in ("ing", "edly", "ed", "es", "s", "ly"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            break
+    if len(word) > 3 and word[-1] == word[-2]:
+        word = word[:-1]
+    return word
+
+def search_pattern(q: str):
+    """Regex for the "phrases" and words of a $text search, negated terms left out; None if nothing is left."""
+    phrases = re.findall(r'(?<!-)"([^"]+)"', q)
+    words = [w for w in re.findall(r"-?\w+", re.sub(r'"[^"]*"', " ", q)) if not w.startswith("-")]
+    # the text index stems words, so a word marks every word starting with its rough stem
+    parts = [re.escape(p) for p in phrases] + [re.escape(rough_stem(w)) + r"\w*" for w in words]
+    if not parts:
+        return None
+    return re.compile(r"\b(?:" + "|".join(parts) + ")", re.IGNORECASE)
+
+def highlight(text: str, pattern) -> str:
+    """Escaped snippet of text around its first match, with every match in it marked."""
+    match = pattern.search(text)
+    start = max(0, match.start() - SNIPPET_CHARS) if match else 0
+    end = min(len(text), (match.end() if match else 0) + SNIPPET_CHARS)
+    snippet = text[start:end]
+    ret = "..." if start else ""
+    last = 0
+    for m in pattern.finditer(snippet):
+        ret += html.escape(snippet[last:m.start()])
+        ret += '<mark class="bg-adminblue text-mattblack">' + html.escape(m.group()) + "</mark>"
+        last = m.end()
+    ret += html.escape(snippet[last:])
+    return ret + ("..." if end < len(text) else "")
+
+def transcript_snippets(chat, pattern):
+    """Highlighted "sender: message" lines for the first messages matching the search."""
+    snippets = []
+    for message in chat.get("messages", []):
+        if message.get("role") == "developer":
+            continue
+        content = message.get("content", "")
+        sender = message_sender(chat, message, chat.get("user1"))
+        if pattern.search(content) or pattern.search(sender):
+            snippets.append(highlight(sender, pattern) + ": " + highlight(content, pattern))
+            if len(snippets) == SNIPPETS_PER_ROOM:
+                break
+    return snippets
+
+def prompt_only_match(chat, pattern) -> bool:
+    """True for a room from before the prompt registry that can only have matched on the prompt in its messages."""
+    prompts = [m.get("content", "") for m in chat.get("messages", []) if m.get("role") == "developer"]
+    if not any(pattern.search(p) for p in prompts):
+        return False
+    said = [chat.get("user1", ""), chat.get("user2", "")]
+    for message in chat.get("messages", []):
+        if message.get("role") != "developer":
+            said += [message.get("content", ""), message.get("sender", "")]
+    return not any(pattern.search(text) for text in said)
+
+def first_message(chat) -> str:
+    for message in chat.get("messages", []):
+        if message.get("role") != "developer":
+            return message_sender(chat, message, chat.get("user1")) + ": " + message.get("content", "")
+    return ""
 
 @adminrouter.get("/")
 async def admin_root(request: Request):
@@ -191,8 +295,25 @@ async def admin_logs(request: Request):
 
     return RedirectResponse(url="/admin/login")
 
+@adminrouter.get("/worker-stats", response_class=JSONResponse)
+async def worker_stats(request: Request):
+    token = request.cookies.get("token")
+    if token:
+        data = verify_jwt(token)
+        if data:
+            if data["type"] == "admin":
+                return JSONResponse(ai_worker_stats())
+    return JSONResponse({"error": "Unauthorized access."}, status_code=401)
+
 @adminrouter.get("/chat-logs", response_class=HTMLResponse)
-async def chat_logs(request: Request):
+async def chat_logs(
+    request: Request,
+    user: str = "",
+    active: str = "",
+    since: str = "",
+    until: str = "",
+    before: str = "",
+):
     token = request.cookies.get("token")
     if token:
         data = verify_jwt(token)
@@ -202,24 +323,122 @@ async def chat_logs(request: Request):
 <tr class="border-2 text-white border-adminblue bg-mattblack">
     <td class="report-td">{user1}</td>
     <td class="report-td">{user2}</td>
+    <td class="report-td">{time}</td>
+    <td class="report-td">{messages}</td>
+    <td class="report-td">{status}</td>
     <td class="report-td">
         <button onclick="window.location.href='/admin/chat/{chat_id}';" class="bg-adminblue text-mattblack w-full px-2 py-1 text-xl">CHATS</button>
     </td>
 </tr>
 """
-                chats = await chatsdb.find({}).to_list(length=1000)
+                query = {}
+                if user:
+                    query["$or"] = [{"user1": user}, {"user2": user}]
+                if active in ("true", "false"):
+                    query["active"] = active == "true"
+                time_range = {}
+                try:
+                    if since:
+                        time_range["$gte"] = parse_admin_time(since)
+                    if until:
+                        time_range["$lt"] = parse_admin_time(until)
+                    # before is the (time, _id) of the last row on the previous page
+                    if before:
+                        before_time, before_id = before.split(",", 1)
+                        before_time = float(before_time)
+                except ValueError:
+                    return JSONResponse({"error": "Invalid filter."}, status_code=400)
+                if time_range:
+                    query["time"] = time_range
+                if before:
+                    query = {"$and": [query, {"$or": [
+                        {"time": {"$lt": before_time}},
+                        {"time": before_time, "_id": {"$lt": before_id}}
+                    ]}]}
+                chats = await chatsdb.find(query, CHAT_LOG_FIELDS).sort(
+                    [("time", -1), ("_id", -1)]
+                ).limit(CHAT_LOG_PAGE_SIZE).to_list(length=CHAT_LOG_PAGE_SIZE)
                 ret = ""
                 for x in chats:
                     ret += chattemplate.format(
-                        user1=x["user1"],
-                        user2=x["user2"],
+                        user1=html.escape(x.get("user1", "")),
+                        user2=html.escape(x.get("user2", "")),
+                        time=datetime.fromtimestamp(x["time"], IST).strftime("%d %b %H:%M:%S") if x.get("time") else "-",
+                        messages=x.get("message_count", 0),
+                        status="active" if x.get("active") else html.escape(guess_summary(x.get("guesses"))),
                         chat_id=x["_id"]
                     )
+                next_url = None
+                if len(chats) == CHAT_LOG_PAGE_SIZE:
+                    last = chats[-1]
+                    next_url = "/admin/chat-logs?" + urlencode({
+                        "user": user, "active": active, "since": since, "until": until,
+                        "before": f"{last.get('time', 0)},{last['_id']}"
+                    })
                 return templates.TemplateResponse(
                     "admin_chat_log.html",
                     {
                         "request": request,
-                        "chats": ret
+                        "chats": ret,
+                        "user": user,
+                        "active": active,
+                        "since": since,
+                        "until": until,
+                        "next_url": next_url
+                    }
+                )
+    return RedirectResponse(url="/admin/login")
+
+@adminrouter.get("/search", response_class=HTMLResponse)
+async def search_chats(request: Request, q: str = "", page: int = 1):
+    token = request.cookies.get("token")
+    if token:
+        data = verify_jwt(token)
+        if data:
+            if data["type"] == "admin":
+                resulttemplate = """
+<tr class="border-2 text-white border-adminblue bg-mattblack">
+    <td class="report-td">{user1}<br>{user2}</td>
+    <td class="report-td">{time}</td>
+    <td class="report-td" style="text-align: left;">{snippets}</td>
+    <td class="report-td">
+        <button onclick="window.location.href='/admin/chat/{chat_id}';" class="bg-adminblue text-mattblack w-full px-2 py-1 text-xl">CHATS</button>
+    </td>
+</tr>
+"""
+                q = q.strip()[:SEARCH_MAX_QUERY]
+                page = max(1, page)
+                pattern = search_pattern(q)
+                ret = ""
+                next_url = None
+                if pattern:
+                    # ranked by the text index, only this page's transcripts leave the server
+                    chats = await chatsdb.find({"$text": {"$search": q}}, SEARCH_FIELDS).sort(
+                        [("score", {"$meta": "textScore"}), ("time", -1), ("_id", -1)]
+                    ).skip((page - 1) * SEARCH_PAGE_SIZE).limit(SEARCH_PAGE_SIZE).to_list(length=SEARCH_PAGE_SIZE)
+                    for x in chats:
+                        # old AI rooms also match on the prompt stored among their messages
+                        if prompt_only_match(x, pattern):
+                            continue
+                        # matched through stemming the highlighter misses, or only on a username
+                        snippets = transcript_snippets(x, pattern) or [highlight(first_message(x), pattern) or "-"]
+                        ret += resulttemplate.format(
+                            user1=highlight(x.get("user1", ""), pattern),
+                            user2=highlight(x.get("user2", ""), pattern),
+                            time=datetime.fromtimestamp(x["time"], IST).strftime("%d %b %H:%M:%S") if x.get("time") else "-",
+                            snippets="<br>".join(snippets),
+                            chat_id=x["_id"]
+                        )
+                    if len(chats) == SEARCH_PAGE_SIZE:
+                        next_url = "/admin/search?" + urlencode({"q": q, "page": page + 1})
+                return templates.TemplateResponse(
+                    "admin_search.html",
+                    {
+                        "request": request,
+                        "results": ret,
+                        "q": q,
+                        "searched": pattern is not None,
+                        "next_url": next_url
                     }
                 )
     return RedirectResponse(url="/admin/login")
@@ -5,19 +5,28 @@
 /api/logout: logout system.
 /api/create-user
 /api/ban
+/api/leaderboard: leaderboard pages, keyset paginated.
+/api/leaderboard/me: caller's rank and the players around them.
 """
 
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Request, Depends
 from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse
-from config import templates, verify_jwt, chatsdb, generate_jwt, IST, no_username_conflict, usersdb, reportsdb, adminlogsdb
-from core.prompts import AI_PROMPT
+from config import templates, verify_jwt, generate_jwt, IST, no_username_conflict, usersdb, reportsdb, adminlogsdb
+from core.rooms import get_room
+from core.session import Session, get_session
+from core import matchmaking, leaderboard
 from datetime import datetime
 from secrets import token_urlsafe
-from uuid import uuid4
-from random import choice, random
+from random import choice
+import time
 
 apirouter = APIRouter(prefix="/api")
-MATCH_LOCK_SECONDS = 15
+LEADERBOARD_PAGE_SIZE = 50
+LEADERBOARD_MAX_PAGE_SIZE = 100
+LEADERBOARD_NEIGHBOURS = 5
+MAX_MATCH_WAIT_SECONDS = 30
+# how often a waiting request re-reads the user when no wake-up is guaranteed
+MATCH_RECHECK_SECONDS = 3
 
 
 @apirouter.get("/login", response_class=HTMLResponse)
@@ -79,6 +88,7 @@ async def api_create_user(request: Request, username: str, password: str):
                     "judged": [],
                 }
                 await usersdb.insert_one(newuser)
+                leaderboard.apply(newuser)
                 try:
                     await adminlogsdb.insert_one({
                         "_id": token_urlsafe(16),
@@ -110,6 +120,7 @@ async def api_ban(request: Request, username: str):
                 user = await usersdb.find_one({"_id": username})
                 if user:
                     await usersdb.update_one({"_id": username}, {"$set": {"banned": True}})
+                    leaderboard.remove(username)
                     try:
                         await adminlogsdb.insert_one({
                             "_id": token_urlsafe(16),
@@ -147,6 +158,7 @@ async def api_unban(request: Request, username: str):
                 user = await usersdb.find_one({"_id": username})
                 if user:
                     await usersdb.update_one({"_id": username}, {"$set": {"banned": False}})
+                    await leaderboard.refresh_user(username)
                     try:
                         await adminlogsdb.insert_one({
                             "_id": token_urlsafe(16),
@@ -175,50 +187,43 @@ async def api_unban(request: Request, username: str):
     )
 
 @apirouter.get("/match-making", response_class=JSONResponse)
-async def api_match_making(request: Request):
-    token = request.cookies.get("token")
-    if token:
-        data = verify_jwt(token)
-        if data:
-            if data["type"] == "user":
-                user = await usersdb.find_one({"_id": data["username"]})
-                if user:
-                    # Block re-queue if user already has an active chat they haven't judged
-                    activeroom = await chatsdb.find_one({"active": True, "$or": [
-                            {"user1": data["username"]},
-                            {"user2": data["username"]}
-                        ]
-                    })
-                    if activeroom and activeroom["_id"] not in user.get("judged", []):
-                        await usersdb.update_one(
-                            {"_id": data["username"]},
-                            {"$set": {"matchmaking": False, "active_chat": activeroom["_id"]}}
-                        )
-                        return JSONResponse(
-                            {
-                                "error": "Already in an active chat."
-                            },
-                            status_code=400
-                        )
-                    if user["matchmaking"]:
-                        return JSONResponse(
-                            {
-                                "error": "Already in queue."
-                            },
-                            status_code=400
-                        )
-                    if user.get("match_target") not in ("AI", "Human"):
-                        await usersdb.update_one(
-                            {"_id": data["username"]},
-                            {"$set": {"matchmaking": True, "match_target": choice(ai_or_human), "human_attempts": 0, "match_lock_until": datetime.now(IST).timestamp()}}
-                        )
-                    else:
-                        await usersdb.update_one({"_id": data["username"]}, {"$set": {"matchmaking": True, "match_lock_until": datetime.now(IST).timestamp()}})
+async def api_match_making(request: Request, session: Session = Depends(get_session)):
+    if session:
+        if session.type == "user":
+            user = session.user
+            if user:
+                # Block re-queue if user already has an active chat they haven't judged
+                if session.unjudged_room or matchmaking.room_pending(user):
+                    await usersdb.update_one(
+                        {"_id": session.username},
+                        {"$set": {"matchmaking": False}}
+                    )
                     return JSONResponse(
                         {
-                            "success": "Added to queue."
-                        }
+                            "error": "Already in an active chat."
+                        },
+                        status_code=400
                     )
+                if user["matchmaking"]:
+                    return JSONResponse(
+                        {
+                            "error": "Already in queue."
+                        },
+                        status_code=400
+                    )
+                target = user.get("match_target")
+                if target not in ("AI", "Human"):
+                    target = choice(ai_or_human)
+                await usersdb.update_one(
+                    {"_id": session.username},
+                    {"$set": {"matchmaking": True, "match_target": target, "match_since": datetime.now(IST).timestamp()}}
+                )
+                matchmaking.join(session.username, target)
+                return JSONResponse(
+                    {
+                        "success": "Added to queue."
+                    }
+                )
     return JSONResponse(
         {
             "error": "Unauthorized access."
@@ -227,171 +232,62 @@ async def api_match_making(request: Request):
     )
 
 ai_or_human = ["AI", "Human"]
+async def matched_room(user):
+    # pairing sets active_chat, so one user read answers the poll
+    chat_id = user.get("active_chat")
+    if chat_id and chat_id not in user.get("judged", []):
+        room = await get_room(chat_id)
+        if room and room.get("active"):
+            return chat_id
+    return None
+
 @apirouter.get("/match-status", response_class=JSONResponse)
-async def api_match_status(request: Request):
+async def api_match_status(request: Request, wait: float = 0):
+    """With wait, hold the request for up to that many seconds until the user is matched."""
     token = request.cookies.get("token")
     if token:
         data = verify_jwt(token)
         if data:
             if data["type"] == "user":
                 user = await usersdb.find_one({"_id": data["username"]})
-                if user:
-                    # Always check if the user is already in an active chat they haven't judged
-                    currentchat1 = await chatsdb.find_one({"user1": user["_id"], "active": True})
-                    currentchat2 = await chatsdb.find_one({"user2": user["_id"], "active": True})
-                    currentchat = currentchat1 or currentchat2
-                    if currentchat and currentchat["_id"] not in user.get("judged", []):
-                        await usersdb.update_one(
-                            {"_id": data["username"]},
-                            {"$set": {"matchmaking": False}}
-                        )
-                        return JSONResponse({"room": currentchat["_id"]})
-                    if user["matchmaking"] == False:
+                deadline = time.monotonic() + min(max(wait, 0), MAX_MATCH_WAIT_SECONDS)
+                while user:
+                    chat_id = await matched_room(user)
+                    if chat_id:
+                        return JSONResponse({"room": chat_id})
+                    if user["matchmaking"]:
+                        # the leader picks the user up on its next scan anyway, this just saves the wait
+                        matchmaking.join(data["username"], user.get("match_target") or "Human")
+                    elif not matchmaking.room_pending(user):
                         return RedirectResponse(url="/dashboard")
-
-                    who = user.get("match_target") or choice(ai_or_human)
-                    now_ts = datetime.now(IST).timestamp()
-                    lock_until = now_ts + MATCH_LOCK_SECONDS
-                    self_lock = await usersdb.update_one(
-                        {
-                            "_id": data["username"],
-                            "$or": [{"match_lock_until": {"$exists": False}}, {"match_lock_until": {"$lt": now_ts}}],
-                            "matchmaking": True
-                        },
-                        {"$set": {"match_lock_until": lock_until}}
-                    )
-                    if self_lock.modified_count == 0:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
                         return JSONResponse({"error": "No match found."}, status_code=404)
-                    if who == "AI":
-                        # if this works, ima kms
-                        currentchat = await chatsdb.find_one({"active": True, "$or": [
-                                {"user1": data["username"]},
-                                {"user2": data["username"]}
-                            ]
-                        })
-                        if currentchat and currentchat["_id"] not in user.get("judged", []):
-                            await usersdb.update_one(
-                                {"_id": data["username"]},
-                                {"$set": {"matchmaking": False}}
-                            )
-                            return JSONResponse({"room": currentchat["_id"]})
-                        chatid = str(uuid4())
-                        ai_first = random() < 0.5
-                        await chatsdb.insert_one({
-                            "_id": chatid,
-                            "messages": [
-                                {
-                                    "role": "developer",
-                                    "content": AI_PROMPT,
-                                }
-                            ],
-                            "user1": data["username"],
-                            "user2": "AI",
-                            "time": datetime.now(IST).timestamp(),
-                            "active": True,
-                            "first": ("AI" if ai_first else data["username"]),
-                                                        "turn_started": datetime.now(IST).timestamp()
-                        })
-                        await usersdb.update_one(
-                            {"_id": data["username"]},
-                            {"$set": {"matchmaking": False, "human_attempts": 0, "active_chat": chatid}, "$unset": {"match_target": ""}}
-                        )
-                        return JSONResponse({"room": chatid})
-                    
-                    currentchat = await chatsdb.find_one({"active": True, "$or": [
-                            {"user1": data["username"]},
-                            {"user2": data["username"]}
-                        ]
-                    })
-                    if currentchat and currentchat["_id"] not in user.get("judged", []):
-                        await usersdb.update_one(
-                            {"_id": data["username"]},
-                            {"$set": {"matchmaking": False}}
-                        )
-                        return JSONResponse({"room": currentchat["_id"]})
-                    # Atomically find and update the first matching user
-                    matched_user = await usersdb.find_one_and_update(
-                        {
-                            "matchmaking": True,
-                            "banned": False,
-                            "$or": [{"active_chat": {"$exists": False}}, {"active_chat": None}],
-                            "$or": [{"match_lock_until": {"$exists": False}}, {"match_lock_until": {"$lt": now_ts}}],
-                            "_id": {"$ne": data["username"]}
-                        },
-                        {"$set": {"matchmaking": False, "human_attempts": 0, "match_lock_until": lock_until}, "$unset": {"match_target": ""}},
-                    )
+                    if not matchmaking.wakes_reliably():
+                        remaining = min(remaining, MATCH_RECHECK_SECONDS)
+                    await matchmaking.wait_for_match(data["username"], remaining)
+                    user = await usersdb.find_one({"_id": data["username"]})
+    return JSONResponse({"error": "Unauthorized access."}, status_code=401)
 
-                    if matched_user:
-                        existing = await chatsdb.find_one({"active": True, "$or": [
-                                {"user1": matched_user["_id"]},
-                                {"user2": matched_user["_id"]}
-                            ]
-                        })
-                        if existing:
-                            await usersdb.update_one(
-                                {"_id": matched_user["_id"]},
-                                {"$set": {"matchmaking": False, "active_chat": existing["_id"]}, "$unset": {"match_lock_until": ""}}
-                            )
-                            await usersdb.update_one(
-                                {"_id": data["username"]},
-                                {"$unset": {"match_lock_until": ""}}
-                            )
-                            return JSONResponse({"error": "No match found."}, status_code=404)
-                        # Update current user's matchmaking status
-                        chatid = str(uuid4())
-                        await usersdb.update_one(
-                            {"_id": data["username"]},
-                            {"$set": {"matchmaking": False, "human_attempts": 0, "active_chat": chatid}, "$unset": {"match_target": "", "match_lock_until": ""}}
-                        )
-                        await usersdb.update_one(
-                            {"_id": matched_user["_id"]},
-                            {"$set": {"active_chat": chatid}, "$unset": {"match_lock_until": ""}}
-                        )
-                        
-                        # Create a new chat room
-                        await chatsdb.insert_one({
-                            "_id": chatid,
-                            "messages": [],
-                            "user1": data["username"],
-                            "user2": matched_user["_id"],
-                            "time": datetime.now(IST).timestamp(),
-                            "active": True,
-                                                    })
-                        
-                        return JSONResponse({"room": chatid})
-                    # If no match found
-                    await usersdb.update_one(
-                        {"_id": data["username"], "match_lock_until": lock_until},
-                        {"$unset": {"match_lock_until": ""}}
-                    )
-                    attempts = user.get("human_attempts", 0) + 1
-                    if attempts >= 3:
-                        # fallback to AI after repeated human misses
-                        chatid = str(uuid4())
-                        ai_first = random() < 0.5
-                        await chatsdb.insert_one({
-                            "_id": chatid,
-                            "messages": [
-                                {
-                                    "role": "developer",
-                                    "content": AI_PROMPT,
-                                }
-                            ],
-                            "user1": data["username"],
-                            "user2": "AI",
-                            "time": datetime.now(IST).timestamp(),
-                            "active": True,
-                            "first": ("AI" if ai_first else data["username"]),
-                                                        "turn_started": datetime.now(IST).timestamp()
-                        })
-                        await usersdb.update_one(
-                            {"_id": data["username"]},
-                            {"$set": {"matchmaking": False, "human_attempts": 0, "active_chat": chatid}, "$unset": {"match_target": "", "match_lock_until": ""}}
-                        )
-                        return JSONResponse({"room": chatid})
-                    await usersdb.update_one(
-                        {"_id": data["username"]},
-                        {"$set": {"human_attempts": attempts, "match_target": "Human"}, "$unset": {"match_lock_until": ""}}
-                    )
-                    return JSONResponse({"error": "No match found."}, status_code=404)
+@apirouter.get("/leaderboard", response_class=JSONResponse)
+async def api_leaderboard(request: Request, after: str = None, limit: int = LEADERBOARD_PAGE_SIZE, session: Session = Depends(get_session)):
+    """Keyset pages of the leaderboard; pass the returned `next` as `after` for the following page."""
+    if session:
+        try:
+            key = leaderboard.decode_cursor(after) if after else None
+        except ValueError:
+            return JSONResponse({"error": "Invalid cursor."}, status_code=400)
+        rows, next_cursor = leaderboard.page(key, min(max(limit, 1), LEADERBOARD_MAX_PAGE_SIZE))
+        return JSONResponse({"rows": rows, "next": next_cursor, "total": len(leaderboard.keys)})
+    return JSONResponse({"error": "Unauthorized access."}, status_code=401)
+
+@apirouter.get("/leaderboard/me", response_class=JSONResponse)
+async def api_leaderboard_me(request: Request, session: Session = Depends(get_session)):
+    if session:
+        if session.type == "user":
+            return JSONResponse({
+                "rank": leaderboard.rank(session.username),
+                "total": len(leaderboard.keys),
+                "rows": leaderboard.around(session.username, LEADERBOARD_NEIGHBOURS)
+            })
     return JSONResponse({"error": "Unauthorized access."}, status_code=401)
@@ -0,0 +1,111 @@
+"""
+Circuit breaker around the completion provider.
+
+Calls from the last BREAKER_WINDOW_SECONDS are kept; once there are enough of them
+and the share that failed or took longer than BREAKER_SLOW_SECONDS crosses
+BREAKER_FAILURE_RATE the breaker opens. While open, completions fail fast and new AI
+rooms are not handed out. After BREAKER_OPEN_SECONDS one probe call is let through
+(half open) and its outcome closes or reopens the breaker.
+"""
+
+import time
+from collections import deque
+
+BREAKER_WINDOW_SECONDS = 60
+BREAKER_MIN_CALLS = 10
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_SLOW_SECONDS = 20
+BREAKER_OPEN_SECONDS = 30
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        window: float = BREAKER_WINDOW_SECONDS,
+        min_calls: int = BREAKER_MIN_CALLS,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        slow_seconds: float = BREAKER_SLOW_SECONDS,
+        open_seconds: float = BREAKER_OPEN_SECONDS
+    ):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        # (finished monotonic time, failed or slow)
+        self.calls = deque()
+        self.opened_at = None
+        self.probing = False
+        self.probe_started = 0.0
+        self.opened = 0
+
+    def trim(self, now: float):
+        while self.calls and self.calls[0][0] < now - self.window:
+            self.calls.popleft()
+
+    def is_open(self) -> bool:
+        """True while calls are refused; a half open breaker counts as closed."""
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.open_seconds
+
+    def refusing(self) -> bool:
+        """True while allow() would refuse a call: open, or half open with the probe still out."""
+        if self.opened_at is None:
+            return False
+        return self.is_open() or (self.probing and time.monotonic() - self.probe_started < self.open_seconds)
+
+    def retry_at(self) -> float:
+        """Monotonic time the next probe is allowed, now when closed."""
+        if self.opened_at is None:
+            return time.monotonic()
+        if self.probing:
+            return max(self.opened_at, self.probe_started) + self.open_seconds
+        return self.opened_at + self.open_seconds
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        # a probe that never reported back does not keep the breaker shut for good
+        if self.refusing():
+            return False
+        self.probing = True
+        self.probe_started = now
+        return True
+
+    def record(self, ok: bool, elapsed: float):
+        now = time.monotonic()
+        bad = not ok or elapsed > self.slow_seconds
+        if self.opened_at is not None:
+            if self.probing:
+                self.probing = False
+                if bad:
+                    self.opened_at = now
+                else:
+                    self.opened_at = None
+                    self.calls.clear()
+            return
+        self.calls.append((now, bad))
+        self.trim(now)
+        if len(self.calls) < self.min_calls:
+            return
+        failures = sum(1 for _, failed in self.calls if failed)
+        if failures / len(self.calls) >= self.failure_rate:
+            self.opened_at = now
+            self.opened += 1
+
+    def stats(self):
+        now = time.monotonic()
+        self.trim(now)
+        state = "closed"
+        if self.opened_at is not None:
+            state = "open" if self.is_open() else "half_open"
+        return {
+            "state": state,
+            "window_calls": len(self.calls),
+            "window_failures": sum(1 for _, failed in self.calls if failed),
+            "times_opened": self.opened,
+        }
@@ -1,15 +1,24 @@
 """
 /chat/{chat-id}: private chat between the two users.
+/chat/{chat-id}/events: server-sent room updates.
 """
 
 from fastapi import APIRouter, Request
-from config import templates, chatsdb, verify_jwt, usersdb, APIKEY, APIKEY1, IST
-from core.prompts import AI_PROMPT, STYLE_PROMPT
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from config import (
+    templates, chatsdb, verify_jwt, usersdb, IST, AI_WORKER_CONCURRENCY, LLM_STREAMING
+)
+from core.prompts import get_prompt
+from core.rooms import update_room, get_room, cache_room
+from core.scheduler import DeadlineScheduler
+from core.breaker import CircuitOpen
+from core import events, rooms, llm, dispatch, openers, partitions, leaderboard
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from datetime import datetime, timedelta
 import os
 import asyncio
 import html
+import json
+import zlib
 import time
 import httpx
 from pymongo import ReturnDocument
@@ -35,8 +44,20 @@ BOUNTY_MULTIPLIER = 0.25
 MAX_SCORE = 120
 AI_LOCK_SECONDS = 180
 AI_NUDGE_SECONDS = 12
+ROOM_SWEEP_SECONDS = 60
+AI_DRAIN_SECONDS = 20
+COMPLETION_RETRY_BASE_SECONDS = 0.5
+COMPLETION_RETRY_MAX_SECONDS = 4
+# least wait before a room whose reply failed is claimed again
+AI_FAILURE_RETRY_SECONDS = 1
+DISPATCH_SWEEP_SECONDS = 30
+# a standalone worker without change streams only finds new rooms by sweeping
+DISPATCH_POLL_SECONDS = 2
+# a reply that takes longer than this could not be delivered inside the turn anyway
+COMPLETION_TIMEOUT_SECONDS = TURN_TIMEOUT_SECONDS - MAX_AI_DELAY_SECONDS
+
+llm_backend = llm.create_backend(COMPLETION_TIMEOUT_SECONDS)
 
-current = APIKEY
 def word_count(text: str) -> int:
     return len([w for w in text.strip().split() if w])
 
@@ -49,7 +70,18 @@ def trim_to_word_limit(text: str, limit: int) -> str:
 def count_role(messages, role: str) -> int:
     return sum(1 for m in messages if m.get("role") == role)
 
+def has_counters(chatdetails) -> bool:
+    # rooms created before the counters were added only have their messages array
+    return "count_user1" in chatdetails
+
+def user_side(chatdetails, username: str) -> str:
+    if chatdetails.get("user2") == "AI" or username == chatdetails.get("user1"):
+        return "user1"
+    return "user2"
+
 def get_counts(chatdetails):
+    if has_counters(chatdetails):
+        return {"user1": chatdetails["count_user1"], "user2": chatdetails["count_user2"]}
     messages = chatdetails.get("messages", [])
     if chatdetails.get("user2") == "AI":
         return {
@@ -63,13 +95,13 @@ def get_counts(chatdetails):
 
 def get_user_counts(chatdetails, username: str):
     counts = get_counts(chatdetails)
-    if chatdetails.get("user2") == "AI":
-        return counts["user1"], counts["user2"]
-    if username == chatdetails.get("user1"):
+    if user_side(chatdetails, username) == "user1":
         return counts["user1"], counts["user2"]
     return counts["user2"], counts["user1"]
 
 def non_dev_message_count(chatdetails) -> int:
+    if has_counters(chatdetails):
+        return chatdetails["message_count"]
     return sum(1 for m in chatdetails.get("messages", []) if m.get("role") != "developer")
 
 def can_guess(chatdetails) -> bool:
@@ -91,6 +123,35 @@ async def clear_active_chat(chatdetails):
         {"$unset": {"active_chat": ""}}
     )
 
+def message_update(chatdetails, side: str, role: str, sender: str, content: str, now: float):
+    """Update that appends a message and keeps the room's counters in step with it."""
+    update = {
+        "$push": {"messages": {"role": role, "content": content, "sender": sender}},
+        "$set": {"last_sender": sender},
+        "$min": {"session_start": now},
+    }
+    if has_counters(chatdetails):
+        update["$inc"] = {"count_"+side: 1, "words_"+side: word_count(content), "message_count": 1}
+    return update
+
+def message_match(chatdetails, side: str):
+    """Filter that only lets a message in while the room is active and the side is under its limit."""
+    match = {"active": True}
+    if has_counters(chatdetails):
+        match["count_"+side] = {"$lt": MAX_MESSAGES_PER_USER}
+    return match
+
+async def after_message(room):
+    counts = get_counts(room)
+    if counts["user1"] >= MAX_MESSAGES_PER_USER and counts["user2"] >= MAX_MESSAGES_PER_USER:
+        await close_room(room)
+    if can_guess(room) and not room.get("guess_unlock_started"):
+        await update_room(
+            room["_id"],
+            {"$set": {"guess_unlock_started": datetime.now(IST).timestamp()}},
+            {"guess_unlock_started": {"$exists": False}}
+        )
+
 def get_last_user_message(messages):
     for msg in reversed(messages):
         if msg.get("role") == "user":
@@ -98,11 +159,16 @@ def get_last_user_message(messages):
     return ""
 
 def should_ai_speak(chatdetails):
-    msgs = [m for m in chatdetails.get("messages", []) if m.get("role") != "developer"]
     now = datetime.now(IST).timestamp()
-    if not msgs:
+    if chatdetails.get("pending_ai"):
+        return False, False
+    if non_dev_message_count(chatdetails) == 0:
         return chatdetails.get("first") == "AI", False
-    last_role = msgs[-1].get("role")
+    if "last_sender" in chatdetails:
+        last_role = "assistant" if chatdetails["last_sender"] == "AI" else "user"
+    else:
+        msgs = [m for m in chatdetails.get("messages", []) if m.get("role") != "developer"]
+        last_role = msgs[-1].get("role")
     last_user_ts = chatdetails.get("last_user_ts", 0)
     last_ai_ts = chatdetails.get("last_ai_ts", 0)
     if last_role == "user" and last_user_ts > last_ai_ts:
@@ -111,13 +177,46 @@ def should_ai_speak(chatdetails):
         return True, True
     return False, False
 
-def build_ai_messages(messages):
-    extra = {"role": "developer", "content": AI_PROMPT}
-    extra_style = {"role": "developer", "content": STYLE_PROMPT}
+def nudge_deadline(chatdetails):
+    if (
+        chatdetails.get("user2") != "AI"
+        or chatdetails.get("first") != "AI"
+        or not chatdetails.get("active")
+        or chatdetails.get("ai_nudged")
+        or not chatdetails.get("last_user_ts")
+    ):
+        return None
+    return chatdetails["last_user_ts"] + AI_NUDGE_SECONDS
+
+def dispatch_ai_room(chatdetails):
+    """Write hook: queue AI rooms whose turn it is, and time the nudge for ones the AI passed on."""
+    if not chatdetails or chatdetails.get("user2") != "AI":
+        return
+    if (
+        chatdetails.get("first") == "AI"
+        and chatdetails.get("active")
+        and not chatdetails.get("ai_lock_until")
+        and partitions.owns(chatdetails["_id"])
+        and should_ai_speak(chatdetails)[0]
+    ):
+        dispatch.enqueue(chatdetails["_id"])
+    ai_nudges.schedule(chatdetails["_id"], nudge_deadline(chatdetails))
+
+async def nudge_room(chat_id):
+    dispatch.enqueue(chat_id)
+
+def build_ai_messages(messages, prompt_id=None):
+    prompt = get_prompt(prompt_id)
+    extra = {"role": "developer", "content": prompt["ai"]}
+    extra_style = {"role": "developer", "content": prompt["style"]}
+    # rooms created before the prompt registry still carry the prompt as a developer message
     cleaned = [m for m in messages if m.get("role") != "developer"]
     return [extra, extra_style] + cleaned
 
 def get_user_message_stats(chatdetails, username: str):
+    if has_counters(chatdetails):
+        side = user_side(chatdetails, username)
+        return chatdetails["count_"+side], chatdetails["words_"+side]
     messages = chatdetails.get("messages", [])
     if chatdetails.get("user2") == "AI":
         role = "user"
@@ -127,6 +226,30 @@ def get_user_message_stats(chatdetails, username: str):
     total_words = sum(word_count(m.get("content", "")) for m in user_messages)
     return len(user_messages), total_words
 
+def message_sender(chatdetails, message, username: str):
+    sender = message.get("sender")
+    if sender:
+        return sender
+    if chatdetails.get("user2") == "AI":
+        return username if message["role"] == "user" else "AI"
+    return message["role"]
+
+def message_delta(chatdetails, username: str, since: int):
+    """Messages after sequence number `since`. A message's seq is its 1-based position in the room."""
+    delta = []
+    for seq, x in enumerate(chatdetails["messages"][max(0, since):], start=max(0, since) + 1):
+        if x["role"] == "developer":
+            continue
+        delta.append({
+            "seq": seq,
+            "mine": message_sender(chatdetails, x, username) == username,
+            "content": x.get("content", "")
+        })
+    return delta
+
+def state_tag(roomstate) -> str:
+    return format(zlib.crc32(json.dumps(roomstate, sort_keys=True).encode()), "08x")
+
 def time_multiplier(time_taken: float) -> float:
     return max(0.4, 1 - (time_taken / 150))
 
@@ -169,6 +292,13 @@ def other_username(chatdetails, username: str):
         return None
     return chatdetails["user2"] if username == chatdetails["user1"] else chatdetails["user1"]
 
+async def close_room(chatdetails, match=None):
+    """Mark an active room inactive. Only the caller whose write lands clears active_chat."""
+    room = await update_room(chatdetails["_id"], {"$set": {"active": False}}, {"active": True, **(match or {})})
+    if room:
+        await clear_active_chat(room)
+    return room
+
 async def finalize_guess_timeout(chatdetails):
     if chatdetails.get("user2") == "AI":
         return
@@ -185,74 +315,175 @@ async def finalize_guess_timeout(chatdetails):
     first_user = next(iter(guesses.keys()))
     first_guess = guesses[first_user]
     other = other_username(chatdetails, first_user)
+    update = {"guess_timeout_handled": True, "active": False}
+    bonus = 0
+    if first_guess.get("correct"):
+        base = int(first_guess.get("score", 0))
+        bonus = compute_bounty(base)
+        update["guesses."+first_user+".bounty"] = bonus
+        update["guesses."+first_user+".final_score"] = base + bonus
+    # the room write picks the one caller that finalizes, user writes follow only for it
+    match = {"guess_timeout_handled": {"$ne": True}}
+    if other:
+        match["guesses."+other] = {"$exists": False}
+    if not await update_room(chatdetails["_id"], {"$set": update}, match):
+        return
     if other:
         await usersdb.update_one(
             {"_id": other},
             {"$addToSet": {"judged": chatdetails["_id"]}}
         )
-    if first_guess.get("correct"):
-        base = int(first_guess.get("score", 0))
-        bonus = compute_bounty(base)
-        if bonus > 0:
-            await usersdb.update_one(
-                {"_id": first_user},
-                {"$inc": {"score": bonus}}
-            )
-        await chatsdb.update_one(
-            {"_id": chatdetails["_id"]},
-            {
-                "$set": {
-                    "guesses."+first_user+".bounty": bonus,
-                    "guesses."+first_user+".final_score": base + bonus,
-                    "guess_timeout_handled": True,
-                    "active": False
-                }
-            }
-        )
-        await clear_active_chat(chatdetails)
-        return
-    await chatsdb.update_one(
-        {"_id": chatdetails["_id"]},
-        {"$set": {"guess_timeout_handled": True, "active": False}}
-    )
+    if bonus > 0:
+        await leaderboard.update_user(first_user, {"$inc": {"score": bonus}})
     await clear_active_chat(chatdetails)
-def compute_ai_delay(messages, completion: str) -> float:
+
+def compute_ai_delay(messages, completion: str, ttft: float = 0.0) -> float:
     last_user = get_last_user_message(messages)
     input_words = word_count(last_user)
     output_words = word_count(completion)
     base_seconds = (max(input_words, output_words) / AVERAGE_WPM) * 60
-    think_seconds = random.uniform(THINK_MIN_SECONDS, THINK_MAX_SECONDS)
+    # waiting for the first token already is the thinking pause, typing starts after it
+    think_seconds = max(ttft, random.uniform(THINK_MIN_SECONDS, THINK_MAX_SECONDS))
     jitter = random.uniform(-1.5, 2.5)
     delay = base_seconds + think_seconds + jitter
     return max(MIN_AI_DELAY_SECONDS, min(MAX_AI_DELAY_SECONDS, delay))
 
 def turn_timed_out(chatdetails) -> bool:
-    start = chatdetails.get("turn_started")
+    start = chatdetails.get("turn_started") or chatdetails.get("time")
     if not start:
         return False
     return (datetime.now(IST).timestamp() - start) > TURN_TIMEOUT_SECONDS
 
-async def get_completion(messages):
-    global current
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    current = (APIKEY1 if current == APIKEY else APIKEY)
-    headers = {
-        "Authorization": f"Bearer {current}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "model": "meta-llama/llama-3.3-70b-instruct",
-        "messages": build_ai_messages(messages),
-        "max_tokens": MAX_OUTPUT_TOKENS
-    }
+def room_deadline(chatdetails):
+    """Next moment a timeout transition is due for this room, or None."""
+    deadlines = []
+    start = chatdetails.get("turn_started") or chatdetails.get("time")
+    if chatdetails.get("active") and start:
+        deadlines.append(start + TURN_TIMEOUT_SECONDS)
+    if (
+        chatdetails.get("user2") != "AI"
+        and chatdetails.get("guess_lock_until")
+        and not chatdetails.get("guess_timeout_handled")
+    ):
+        deadlines.append(chatdetails["guess_lock_until"])
+    return min(deadlines) if deadlines else None
+
+async def expire_room(chat_id):
+    chatdetails = cache_room(await chatsdb.find_one({"_id": chat_id}))
+    if not chatdetails:
+        return
+    if chatdetails.get("active") and turn_timed_out(chatdetails):
+        await close_room(chatdetails, {"turn_started": chatdetails.get("turn_started")})
+    await finalize_guess_timeout(chatdetails)
+    # a deadline that fired early or was moved by another worker's write
+    chatdetails = await get_room(chat_id)
+    deadline = room_deadline(chatdetails) if chatdetails else None
+    if deadline and deadline > datetime.now(IST).timestamp():
+        room_deadlines.schedule(chat_id, deadline)
+
+def schedule_room_deadline(chatdetails):
+    if chatdetails:
+        room_deadlines.schedule(chatdetails["_id"], room_deadline(chatdetails))
+
+async def sweep_overdue_rooms():
+    """Expire rooms whose deadline passed while no worker had it scheduled, e.g. after a restart."""
+    while True:
+        try:
+            now = datetime.now(IST).timestamp()
+            cutoff = now - TURN_TIMEOUT_SECONDS
+            overdue = chatsdb.find(
+                {"$or": [
+                    {"active": True, "turn_started": {"$lt": cutoff}},
+                    {"active": True, "turn_started": None, "time": {"$lt": cutoff}},
+                    {"guess_lock_until": {"$lt": now}, "guess_timeout_handled": {"$ne": True}, "user2": {"$ne": "AI"}},
+                ]},
+                {"_id": 1}
+            )
+            async for x in overdue:
+                if x["_id"] not in room_deadlines.deadlines:
+                    room_deadlines.schedule(x["_id"], now)
+        except Exception as e:
+            print(f"Error sweeping rooms: {e}")
+        await asyncio.sleep(ROOM_SWEEP_SECONDS)
+
+async def sweep_unreleased_replies():
+    """Release AI replies left parked by a worker that stopped before their typing delay was over."""
+    while True:
+        try:
+            now = datetime.now(IST).timestamp()
+            unreleased = chatsdb.find({"pending_ai.release_at": {"$lt": now}}, {"_id": 1})
+            async for x in unreleased:
+                if x["_id"] not in ai_releases.deadlines:
+                    ai_releases.schedule(x["_id"], now)
+        except Exception as e:
+            print(f"Error sweeping AI replies: {e}")
+        await asyncio.sleep(ROOM_SWEEP_SECONDS)
+
+room_deadlines = DeadlineScheduler(expire_room)
+ai_nudges = DeadlineScheduler(nudge_room)
+ai_retries = DeadlineScheduler(nudge_room)
+
+async def get_completion(messages, prompt_id=None, timeout=None):
+    """Returns (text, time to first token in seconds)."""
+    return await llm.guarded_complete(
+        llm_backend, build_ai_messages(messages, prompt_id), MAX_OUTPUT_TOKENS, MAX_WORDS_PER_MESSAGE, timeout
+    )
+
+def completion_deadline(chatdetails) -> float:
+    """Latest moment a reply can be ready and still be delivered inside the turn."""
+    start = chatdetails.get("turn_started") or chatdetails.get("time") or datetime.now(IST).timestamp()
+    return start + TURN_TIMEOUT_SECONDS - MIN_AI_DELAY_SECONDS
+
+def retryable(error) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return not isinstance(error, CircuitOpen)
+
+async def complete_within_turn(x):
+    """get_completion retried with jittered backoff for as long as the room's turn leaves time."""
+    deadline = completion_deadline(x)
+    attempt = 0
+    while True:
+        budget = deadline - datetime.now(IST).timestamp()
+        if budget <= 0:
+            raise asyncio.TimeoutError("turn budget spent")
+        try:
+            return await get_completion(x["messages"], x.get("prompt"), budget)
+        except Exception as e:
+            attempt += 1
+            backoff = random.uniform(0, min(COMPLETION_RETRY_MAX_SECONDS, COMPLETION_RETRY_BASE_SECONDS * 2 ** attempt))
+            if not retryable(e) or datetime.now(IST).timestamp() + backoff >= deadline:
+                raise
+            print(f"Completion for {x['_id']} failed (attempt {attempt}), retrying: {e}")
+            await asyncio.sleep(backoff)
+
+def retry_after_failure(x):
+    """Epoch time a failed room should be claimed again."""
+    now = datetime.now(IST).timestamp()
+    # half open counts too: while the probe is out every other call is refused
+    if llm.breaker.refusing():
+        return now + max(AI_FAILURE_RETRY_SECONDS, llm.breaker.retry_at() - time.monotonic())
+    deadline = completion_deadline(x)
+    if deadline <= now:
+        # no reply can make it in time, room_deadlines closes the room at the turn timeout
+        return deadline + MIN_AI_DELAY_SECONDS
+    # never straight away, a failure that is not the provider's would spin the claim loop
+    return now + AI_FAILURE_RETRY_SECONDS
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json=payload, headers=headers)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        resp = response.json()
-        return resp["choices"][0]["message"]["content"]
+completion_ttft = None
+
+def record_ttft(ttft: float):
+    """Moving average of time to first token (whole call time when not streaming)."""
+    global completion_ttft
+    completion_ttft = ttft if completion_ttft is None else 0.9 * completion_ttft + 0.1 * ttft
+
+async def generate_opener(prompt_id):
+    completion, ttft = await get_completion([], prompt_id)
+    return trim_to_word_limit(completion, MAX_WORDS_PER_MESSAGE)
 
 async def process_chat(x):
+    retry_at = None
     try:
         should_speak, nudged = should_ai_speak(x)
         if not should_speak:
@@ -260,101 +491,257 @@ async def process_chat(x):
         messages = x["messages"]
         counts = get_counts(x)
         if turn_timed_out(x):
-            await chatsdb.update_one(
-                {"_id": x["_id"]},
-                {"$set": {"active": False}}
-            )
-            await clear_active_chat(x)
+            await close_room(x)
             return
         should_end = counts["user2"] >= MAX_MESSAGES_PER_USER and counts["user1"] >= MAX_MESSAGES_PER_USER
         if should_end:
-            await chatsdb.update_one(
-                {"_id": x["_id"]},
-                {"$set": {"active": False}}
-            )
-            await clear_active_chat(x)
+            await close_room(x)
             return
-        await chatsdb.update_one(
-            {"_id": x["_id"]},
+        await update_room(
+            x["_id"],
             {"$set": {"ai_lock_until": datetime.now(IST) + timedelta(seconds=AI_LOCK_SECONDS)}}
         )
-        call_started = time.monotonic()
-        completion = await get_completion(messages)
-        call_elapsed = time.monotonic() - call_started
-        completion = trim_to_word_limit(completion, MAX_WORDS_PER_MESSAGE)
-        target_delay = compute_ai_delay(messages, completion)
-        remaining = max(0.0, target_delay - call_elapsed)
-        if remaining:
-            await asyncio.sleep(remaining)
-        chat_id = x["_id"]
-        new_ai_count = counts["user2"] + 1
-        should_end = new_ai_count >= MAX_MESSAGES_PER_USER and counts["user1"] >= MAX_MESSAGES_PER_USER
-        first_non_dev = non_dev_message_count(x) == 0
-        await chatsdb.update_one(
-            {"_id": chat_id},
-            {
-                "$push": {"messages": {"role": "assistant", "content": completion, "sender": "AI"}},
-                "$set": {
-                    "first": x["user1"],
-                    "active": not should_end,
-                    "turn_started": datetime.now(IST).timestamp(),
-                    "last_ai_ts": datetime.now(IST).timestamp(),
-                    **({"ai_nudged": True} if nudged else {}),
-                    **({"session_start": datetime.now(IST).timestamp()} if first_non_dev else {})
-                }
-            }
+        # an empty room needs no context, a pooled opener skips the completion call
+        opener = openers.take(x.get("prompt")) if non_dev_message_count(x) == 0 else None
+        if opener:
+            completion = opener
+            remaining = compute_ai_delay(messages, completion)
+        else:
+            call_started = time.monotonic()
+            completion, ttft = await complete_within_turn(x)
+            call_elapsed = time.monotonic() - call_started
+            record_ttft(ttft)
+            completion = trim_to_word_limit(completion, MAX_WORDS_PER_MESSAGE)
+            target_delay = compute_ai_delay(messages, completion, ttft if LLM_STREAMING else 0.0)
+            remaining = max(0.0, target_delay - call_elapsed)
+        # park the reply on the room, ai_releases publishes it once the typing delay is over
+        await update_room(
+            x["_id"],
+            {"$set": {"pending_ai": {
+                "content": completion,
+                "release_at": datetime.now(IST).timestamp() + remaining,
+                "nudged": nudged
+            }}},
+            {"active": True}
         )
-        if should_end:
-            await clear_active_chat(x)
     except Exception as e:
         print(f"Error processing chat {x['_id']}: {e}")
+        retry_at = retry_after_failure(x)
     finally:
         try:
-            await chatsdb.update_one(
-                {"_id": x["_id"]},
-                {"$unset": {"ai_lock_until": "", "ai_lock_owner": ""}}
-            )
+            if retry_at:
+                # keep the lease until the room can be tried again, otherwise it is re-dispatched at once
+                await update_room(
+                    x["_id"],
+                    {"$set": {"ai_lock_until": datetime.fromtimestamp(retry_at, IST)}}
+                )
+                ai_retries.schedule(x["_id"], retry_at)
+            else:
+                await update_room(
+                    x["_id"],
+                    {"$unset": {"ai_lock_until": "", "ai_lock_owner": ""}}
+                )
         except Exception:
             pass
 
-async def claim_one_chat():
+async def release_ai_message(chat_id):
+    x = await get_room(chat_id)
+    pending = x.get("pending_ai") if x else None
+    if not pending:
+        return
+    now = datetime.now(IST).timestamp()
+    if pending["release_at"] > now:
+        ai_releases.schedule(chat_id, pending["release_at"])
+        return
+    update = message_update(x, "user2", "assistant", "AI", pending["content"], now)
+    update["$set"].update({
+        "first": x["user1"],
+        "turn_started": now,
+        "last_ai_ts": now,
+        **({"ai_nudged": True} if pending.get("nudged") else {})
+    })
+    update["$unset"] = {"pending_ai": ""}
+    # matching on release_at makes sure a reply is published once even if several workers fire
+    match = {**message_match(x, "user2"), "pending_ai.release_at": pending["release_at"]}
+    room = await update_room(chat_id, update, match)
+    if room:
+        await after_message(room)
+        return
+    # the room closed while the reply was waiting
+    await update_room(chat_id, {"$unset": {"pending_ai": ""}}, {"pending_ai.release_at": pending["release_at"]})
+
+def schedule_ai_release(chatdetails):
+    if chatdetails:
+        pending = chatdetails.get("pending_ai")
+        ai_releases.schedule(chatdetails["_id"], pending["release_at"] if pending else None)
+
+ai_releases = DeadlineScheduler(release_ai_message)
+
+def claimable_filter(now):
+    return {
+        "active": True,
+        "first": "AI",
+        "pending_ai": {"$exists": False},
+        "$and": [
+            {"$or": [
+                {"ai_lock_until": {"$exists": False}},
+                {"ai_lock_until": {"$lt": now}}
+            ]},
+            partitions.claim_filter()
+        ]
+    }
+
+async def claim_one_chat(chat_id=None):
     now = datetime.now(IST)
     lock_until = now + timedelta(seconds=AI_LOCK_SECONDS)
-    return await chatsdb.find_one_and_update(
+    return cache_room(await chatsdb.find_one_and_update(
         {
-            "active": True,
-            "first": "AI",
-            "$or": [
-                {"ai_lock_until": {"$exists": False}},
-                {"ai_lock_until": {"$lt": now}}
-            ]
+            **({"_id": chat_id} if chat_id else {}),
+            **claimable_filter(now)
         },
         {
             "$set": {
                 "ai_lock_until": lock_until,
                 "ai_lock_owner": str(os.getpid())
-            }
+            },
+            "$inc": {"v": 1}
         },
         return_document=ReturnDocument.AFTER
-    )
+    ))
+
+async def sweep_ai_rooms():
+    """Queue claimable rooms whose dispatch was lost, e.g. the worker that got it restarted."""
+    async for x in chatsdb.find(claimable_filter(datetime.now(IST)), {"_id": 1}).limit(200):
+        dispatch.enqueue(x["_id"])
+
+standalone_worker = False
+
+async def claim_next_chat():
+    timeout = DISPATCH_SWEEP_SECONDS
+    if standalone_worker and not events.relay_active:
+        timeout = DISPATCH_POLL_SECONDS
+    try:
+        chat_id = await dispatch.next_room(timeout)
+    except asyncio.TimeoutError:
+        await sweep_ai_rooms()
+        return None
+    return await claim_one_chat(chat_id)
+
+ai_slots = asyncio.Semaphore(AI_WORKER_CONCURRENCY)
+ai_in_flight = 0
+ai_tasks = set()
+
+def ai_worker_stats():
+    return {
+        "queue_depth": dispatch.queue.qsize(),
+        "in_flight": ai_in_flight,
+        "concurrency": AI_WORKER_CONCURRENCY,
+        "partitions": sorted(partitions.owned) if partitions.enabled() else "all",
+        "ttft_avg": round(completion_ttft, 3) if completion_ttft is not None else None,
+        "llm": llm_backend.stats(),
+        "breaker": llm.breaker.stats(),
+        "openers": openers.opener_stats(),
+    }
+
+async def run_chat(x):
+    global ai_in_flight
+    try:
+        await process_chat(x)
+    finally:
+        ai_in_flight -= 1
+        ai_slots.release()
 
 async def get_completion_loop():
+    """Claim a room whenever a slot is free; a slow room only holds its own slot."""
+    global ai_in_flight
     while True:
+        await ai_slots.acquire()
         try:
-            claimed = []
-            for _ in range(200):
-                x = await claim_one_chat()
-                if not x:
-                    break
-                claimed.append(x)
-            tasks = [asyncio.create_task(process_chat(x)) for x in claimed]
-            if tasks:
-                await asyncio.gather(*tasks)
-            await asyncio.sleep(0.2)
+            x = await claim_next_chat()
         except Exception as e:
             print(f"Error in loop: {e}")
+            x = None
+        if not x:
+            ai_slots.release()
+            continue
+        ai_in_flight += 1
+        task = asyncio.create_task(run_chat(x))
+        ai_tasks.add(task)
+        task.add_done_callback(ai_tasks.discard)
+
+# background tasks, started from app.py's lifespan (web) and core/worker.py (AI worker)
+room_tasks = []
+ai_worker_tasks = []
+relay_task = None
+
+def start_relay():
+    global relay_task
+    if relay_task is None:
+        relay_task = asyncio.create_task(events.relay_room_changes())
+
+def start_room_tasks():
+    """Room timeouts for the rooms this process serves."""
+    start_relay()
+    rooms.write_hooks.append(schedule_room_deadline)
+    room_tasks.extend([
+        asyncio.create_task(room_deadlines.run()),
+        asyncio.create_task(sweep_overdue_rooms()),
+    ])
 
-asyncio.create_task(get_completion_loop())
+def start_ai_worker(standalone: bool = False):
+    """Claim AI rooms, generate replies and release them after the typing delay."""
+    global standalone_worker
+    standalone_worker = standalone
+    start_relay()
+    rooms.write_hooks.append(dispatch_ai_room)
+    rooms.write_hooks.append(schedule_ai_release)
+    events.watchers.append(dispatch.on_room_change)
+    partitions.acquire_hooks.append(lambda: asyncio.create_task(sweep_ai_rooms()))
+    ai_worker_tasks.extend([
+        asyncio.create_task(get_completion_loop()),
+        asyncio.create_task(partitions.run()),
+        asyncio.create_task(ai_nudges.run()),
+        asyncio.create_task(ai_retries.run()),
+        asyncio.create_task(ai_releases.run()),
+        asyncio.create_task(sweep_unreleased_replies()),
+        asyncio.create_task(openers.run(generate_opener)),
+        asyncio.create_task(llm.publish_breaker()),
+    ])
+
+async def cancel_tasks(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    tasks.clear()
+
+async def stop_ai_worker(timeout: float = AI_DRAIN_SECONDS):
+    """Stop claiming rooms, then give in-flight replies up to timeout seconds to finish and be released."""
+    if not ai_worker_tasks:
+        return
+    # the completion loop is the first task, nothing new is claimed after this
+    await cancel_tasks(ai_worker_tasks[:1])
+    del ai_worker_tasks[0]
+    drain_until = time.monotonic() + timeout
+    if ai_tasks:
+        await asyncio.wait(set(ai_tasks), timeout=timeout)
+    while len(ai_releases) and time.monotonic() < drain_until:
+        await asyncio.sleep(0.2)
+    if ai_tasks or len(ai_releases):
+        # leases run out and other workers' sweeps pick these rooms up
+        print(f"AI worker stopped with {len(ai_tasks)} replies in flight and {len(ai_releases)} unreleased")
+    await cancel_tasks(list(ai_tasks))
+    await cancel_tasks(ai_worker_tasks)
+    try:
+        await partitions.release_all()
+    except Exception as e:
+        print(f"Error releasing AI partitions: {e}")
+
+async def stop_room_tasks():
+    global relay_task
+    await cancel_tasks(room_tasks)
+    if relay_task is not None:
+        await cancel_tasks([relay_task])
+        relay_task = None
 
 @chatrouter.get("/{chat_id}", response_class=HTMLResponse)
 async def get_chat(request: Request, chat_id: str):
@@ -363,12 +750,12 @@ async def get_chat(request: Request, chat_id: str):
         data = verify_jwt(token)
         if data:
             if data["type"] == "user":
-                chatdetails = await chatsdb.find_one({"_id": chat_id})
+                chatdetails = await get_room(chat_id)
                 if chatdetails:
                     first = chatdetails.get("first")
                     if not first:
-                        await chatsdb.update_one(
-                            {"_id": chat_id},
+                        await update_room(
+                            chat_id,
                             {"$set": {"first": data["username"], "turn_started": datetime.now(IST).timestamp()}}
                         )
                     
@@ -383,8 +770,8 @@ async def get_chat(request: Request, chat_id: str):
                         )
 
                     if chatdetails.get("turn_started") is None:
-                        await chatsdb.update_one(
-                            {"_id": chat_id},
+                        await update_room(
+                            chat_id,
                             {"$set": {"turn_started": datetime.now(IST).timestamp()}}
                         )
 
@@ -401,6 +788,22 @@ async def get_chat(request: Request, chat_id: str):
                     
     return RedirectResponse("/login")
 
+@chatrouter.get("/{chat_id}/events")
+async def room_events(request: Request, chat_id: str):
+    token = request.cookies.get("token")
+    if token:
+        data = verify_jwt(token)
+        if data:
+            if data["type"] == "user":
+                chatdetails = await get_room(chat_id)
+                if chatdetails and data["username"] in (chatdetails["user1"], chatdetails["user2"]):
+                    return StreamingResponse(
+                        events.stream(request, chat_id),
+                        media_type="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+                    )
+    return JSONResponse({"status": "error", "message": "Invalid token."}, status_code=401)
+
 @chatrouter.get("/{chat_id}/send")
 async def send_message(request: Request, chat_id: str, message: str):
     token = request.cookies.get("token")
@@ -408,150 +811,103 @@ async def send_message(request: Request, chat_id: str, message: str):
         data = verify_jwt(token)
         if data:
             if data["type"] == "user":
-                chatdetails = await chatsdb.find_one({"_id": chat_id})
+                chatdetails = await get_room(chat_id)
                 if chatdetails:
                     if chatdetails["active"] == False:
                         return JSONResponse({"status": "error", "message": "Chat has been ended."}, status_code=400)
                     if turn_timed_out(chatdetails):
-                        await chatsdb.update_one(
-                            {"_id": chat_id},
-                            {"$set": {"active": False}}
-                        )
-                        await clear_active_chat(chatdetails)
-                        return JSONResponse({"status": "error", "message": "Chat timed out."}, status_code=400)
+                        # a stale copy may have missed a newer turn, only close the turn we saw time out
+                        if await close_room(chatdetails, {"turn_started": chatdetails.get("turn_started")}):
+                            return JSONResponse({"status": "error", "message": "Chat timed out."}, status_code=400)
+                        chatdetails = cache_room(await chatsdb.find_one({"_id": chat_id}))
+                        if not chatdetails or not chatdetails["active"] or turn_timed_out(chatdetails):
+                            return JSONResponse({"status": "error", "message": "Chat timed out."}, status_code=400)
                     if word_count(message) > MAX_WORDS_PER_MESSAGE:
                         return JSONResponse(
                             {"status": "error", "message": f"Word limit is {MAX_WORDS_PER_MESSAGE} words."},
                             status_code=400
                         )
+                    if data["username"] not in (chatdetails["user1"], chatdetails["user2"]):
+                        return JSONResponse({"status": "error", "message": "Invalid token."}, status_code=401)
                     user_count, other_count = get_user_counts(chatdetails, data["username"])
                     if user_count >= MAX_MESSAGES_PER_USER:
                         return JSONResponse(
                             {"status": "error", "message": "Message limit reached."},
                             status_code=400
                         )
-                    
-                    if chatdetails["user2"] == "AI":
-                        new_user_count = user_count + 1
-                        should_end = new_user_count >= MAX_MESSAGES_PER_USER and other_count >= MAX_MESSAGES_PER_USER
-                        first_non_dev = non_dev_message_count(chatdetails) == 0
-                        await chatsdb.update_one(
-                            {
-                                "_id": chat_id
-                            },
-                            {
-                                "$push": {
-                                    "messages": {
-                                        "role": "user",
-                                        "content": message,
-                                        "sender": data["username"]
-                                    }
-                                },
-                                "$set": {
-                                    "first": "AI",
-                                    "active": not should_end,
-                                    "last_user_ts": datetime.now(IST).timestamp(),
-                                    "turn_started": datetime.now(IST).timestamp(),
-                                    **({"session_start": datetime.now(IST).timestamp()} if first_non_dev else {})
-                                }
-                            }
-                        )
-                        if should_end:
-                            await clear_active_chat(chatdetails)
-                        return JSONResponse({"status": "success"})
-                    
-                    if data["username"] in chatdetails["user1"]:
-                        new_user_count = user_count + 1
-                        should_end = new_user_count >= MAX_MESSAGES_PER_USER and other_count >= MAX_MESSAGES_PER_USER
-                        first_non_dev = non_dev_message_count(chatdetails) == 0
-                        await chatsdb.update_one(
-                            {
-                                "_id": chat_id
-                            },
-                            {
-                                "$push": {
-                                    "messages": {
-                                        "role": data["username"],
-                                        "content": message,
-                                        "sender": data["username"]
-                                    }
-                                },
-                                "$set": {
-                                    "active": not should_end,
-                                    "turn_started": datetime.now(IST).timestamp(),
-                                    **({"session_start": datetime.now(IST).timestamp()} if first_non_dev else {})
-                                }
-                            }
-                        )
-                        if should_end:
-                            await clear_active_chat(chatdetails)
-                        return JSONResponse({"status": "success"})
-                    elif data["username"] in chatdetails["user2"]:
-                        new_user_count = user_count + 1
-                        should_end = new_user_count >= MAX_MESSAGES_PER_USER and other_count >= MAX_MESSAGES_PER_USER
-                        first_non_dev = non_dev_message_count(chatdetails) == 0
-                        await chatsdb.update_one(
-                            {
-                                "_id": chat_id
-                            },
-                            {
-                                "$push": {
-                                    "messages": {
-                                        "role": data["username"],
-                                        "content": message,
-                                        "sender": data["username"]
-                                    }
-                                },
-                                "$set": {
-                                    "active": not should_end,
-                                    "turn_started": datetime.now(IST).timestamp(),
-                                    **({"session_start": datetime.now(IST).timestamp()} if first_non_dev else {})
-                                }
-                            }
+
+                    is_ai_chat = chatdetails["user2"] == "AI"
+                    side = user_side(chatdetails, data["username"])
+                    now = datetime.now(IST).timestamp()
+                    update = message_update(
+                        chatdetails,
+                        side,
+                        "user" if is_ai_chat else data["username"],
+                        data["username"],
+                        message,
+                        now
+                    )
+                    update["$set"]["turn_started"] = now
+                    if is_ai_chat:
+                        update["$set"].update({"first": "AI", "last_user_ts": now})
+                    # the limit is checked again inside the write, a racing second send is rejected there
+                    room = await update_room(chat_id, update, message_match(chatdetails, side))
+                    if not room:
+                        return JSONResponse(
+                            {"status": "error", "message": "Message limit reached."},
+                            status_code=400
                         )
-                        if should_end:
-                            await clear_active_chat(chatdetails)
-                        return JSONResponse({"status": "success"})
-                        
+                    await after_message(room)
+                    return JSONResponse({"status": "success"})
+
     return JSONResponse({"status": "error", "message": "Invalid token."}, status_code=401)
 
 @chatrouter.get("/{chat_id}/get")
-async def get_message(request: Request, chat_id: str):
+async def get_message(request: Request, chat_id: str, since: int = None, state: str = None):
     token = request.cookies.get("token")
     if token:
         data = verify_jwt(token)
         if data:
             if data["type"] == "user":
-                chatdetails = await chatsdb.find_one({"_id": chat_id})
+                chatdetails = await get_room(chat_id)
                 if chatdetails:
-                    await finalize_guess_timeout(chatdetails)
-                    if can_guess(chatdetails) and not chatdetails.get("guess_unlock_started"):
-                        now = datetime.now(IST).timestamp()
-                        await chatsdb.update_one(
-                            {"_id": chat_id, "guess_unlock_started": {"$exists": False}},
-                            {"$set": {"guess_unlock_started": now}}
-                        )
-                        chatdetails["guess_unlock_started"] = now
-                    if chatdetails["active"] and turn_timed_out(chatdetails):
-                        await chatsdb.update_one(
-                            {"_id": chat_id},
-                            {"$set": {"active": False}}
-                        )
-                        chatdetails["active"] = False
-                        await clear_active_chat(chatdetails)
                     user_count, other_count = get_user_counts(chatdetails, data["username"])
                     guesses = chatdetails.get("guesses", {})
                     user_has_guessed = data["username"] in guesses
                     guess_lock_until = chatdetails.get("guess_lock_until")
-                    guess_expired = False
-                    if guess_lock_until and datetime.now(IST).timestamp() > guess_lock_until:
-                        guess_expired = True
-                        await chatsdb.update_one(
-                            {"_id": chat_id},
-                            {"$set": {"active": False}}
-                        )
-                        chatdetails["active"] = False
-                        await clear_active_chat(chatdetails)
+                    # timeouts are applied by room_deadlines, reads only report them
+                    guess_expired = bool(guess_lock_until and datetime.now(IST).timestamp() > guess_lock_until)
+                    roomstate = {
+                        "first": chatdetails["first"],
+                        "active": chatdetails["active"],
+                        "user_count": user_count,
+                        "other_count": other_count,
+                        "turn_started": chatdetails.get("turn_started"),
+                        "message_count": non_dev_message_count(chatdetails),
+                        "can_guess": can_guess(chatdetails),
+                        "guess_lock_until": guess_lock_until,
+                        "guess_lock_started": chatdetails.get("guess_lock_started"),
+                        "user_has_guessed": user_has_guessed,
+                        "guess_expired": guess_expired
+                    }
+                    limits = {
+                        "max_messages": MAX_MESSAGES_PER_USER,
+                        "max_words": MAX_WORDS_PER_MESSAGE,
+                        "turn_timeout": TURN_TIMEOUT_SECONDS,
+                        "guess_window_seconds": GUESS_GRACE_SECONDS,
+                    }
+                    if since is not None:
+                        # delta fetch: messages after seq `since`, state only when its tag changed
+                        ret = {
+                            "status": "success",
+                            "seq": len(chatdetails["messages"]),
+                            "messages": message_delta(chatdetails, data["username"], since),
+                        }
+                        tag = state_tag(roomstate)
+                        if tag != state:
+                            ret["state"] = {**roomstate, **limits} if since == 0 else roomstate
+                            ret["state_tag"] = tag
+                        return ret
                     othertemplate = """
 <div class="other-div">
     <div class="other-text" style="text-align: left !important;">
@@ -567,40 +923,15 @@ async def get_message(request: Request, chat_id: str):
 </div>
 """
                     ret = ""
-                    is_ai_chat = chatdetails.get("user2") == "AI"
                     for x in chatdetails["messages"]:
                         if x["role"] == "developer":
                             continue
-                        sender = x.get("sender")
-                        if not sender:
-                            if is_ai_chat:
-                                sender = data["username"] if x["role"] == "user" else "AI"
-                            else:
-                                sender = x["role"]
                         safe_content = html.escape(x.get("content", ""))
-                        if sender == data["username"]:
+                        if message_sender(chatdetails, x, data["username"]) == data["username"]:
                             ret += usertemplate.format(content=safe_content)
                         else:
                             ret += othertemplate.format(content=safe_content)
-                    return {
-                        "status": "success",
-                        "messages": ret,
-                        "first": chatdetails["first"],
-                        "active": chatdetails["active"],
-                        "user_count": user_count,
-                        "other_count": other_count,
-                        "max_messages": MAX_MESSAGES_PER_USER,
-                        "max_words": MAX_WORDS_PER_MESSAGE,
-                        "turn_started": chatdetails.get("turn_started"),
-                        "turn_timeout": TURN_TIMEOUT_SECONDS,
-                        "message_count": non_dev_message_count(chatdetails),
-                        "can_guess": can_guess(chatdetails),
-                        "guess_lock_until": guess_lock_until,
-                        "guess_lock_started": chatdetails.get("guess_lock_started"),
-                        "guess_window_seconds": GUESS_GRACE_SECONDS,
-                        "user_has_guessed": user_has_guessed,
-                        "guess_expired": guess_expired
-                    }
+                    return {"status": "success", "messages": ret, **roomstate, **limits}
                     
     return JSONResponse({"status": "error", "message": "Invalid token."}, status_code=401)
 
@@ -611,13 +942,11 @@ async def end_chat(request: Request, chat_id: str):
         data = verify_jwt(token)
         if data:
             if data["type"] == "user":
-                chatdetails = await chatsdb.find_one({"_id": chat_id})
+                chatdetails = await get_room(chat_id)
                 if chatdetails:
                     if data["username"] in chatdetails["user1"]:
-                        await chatsdb.update_one(
-                            {
-                                "_id": chat_id
-                            },
+                        await update_room(
+                            chat_id,
                             {
                                 "$set": {
                                     "active": False
@@ -627,10 +956,8 @@ async def end_chat(request: Request, chat_id: str):
                         await clear_active_chat(chatdetails)
                         return {"status": "success"}
                     elif data["username"] in chatdetails["user2"]:
-                        await chatsdb.update_one(
-                            {
-                                "_id": chat_id
-                            },
+                        await update_room(
+                            chat_id,
                             {
                                 "$set": {
                                     "active": False
@@ -648,7 +975,8 @@ async def routerjudgement(request: Request, chat_id: str, judgement: str):
         data = verify_jwt(token)
         if data:
             if data["type"] == "user":
-                chatdetails = await chatsdb.find_one({"_id": chat_id})
+                # scoring and the guess window depend on the other player's guess, never decide them on a cached copy
+                chatdetails = cache_room(await chatsdb.find_one({"_id": chat_id}))
                 if chatdetails:
                     userdata = await usersdb.find_one({"_id": data["username"]})
                     if not can_guess(chatdetails):
@@ -664,8 +992,8 @@ async def routerjudgement(request: Request, chat_id: str, judgement: str):
                     score = compute_score(chatdetails, data["username"]) if correct else 0
 
                     if is_ai_chat:
-                        await chatsdb.update_one(
-                            {"_id": chat_id},
+                        await update_room(
+                            chat_id,
                             {
                                 "$set": {
                                     "active": False,
@@ -683,7 +1011,7 @@ async def routerjudgement(request: Request, chat_id: str, judgement: str):
                         update = {"$push": {"judged": chat_id}}
                         if correct:
                             update["$inc"] = {"score": score}
-                        await usersdb.update_one({"_id": data["username"]}, update)
+                        await leaderboard.update_user(data["username"], update)
                         if chatdetails["user2"] == "AI":
                             verdict = "You+Were+Talking+To+An+AI"
                             title = "Congratulations" if correct else "Oh+No"
@@ -710,12 +1038,20 @@ async def routerjudgement(request: Request, chat_id: str, judgement: str):
                             "guess_lock_until": now + GUESS_GRACE_SECONDS,
                             "guess_lock_started": now
                         })
-                    await chatsdb.update_one({"_id": chat_id}, {"$set": update_chat})
+                        if not await update_room(chat_id, {"$set": update_chat}, {"guess_lock_until": {"$exists": False}}):
+                            # the other player's guess landed since the read, this one is the second
+                            chatdetails = cache_room(await chatsdb.find_one({"_id": chat_id}))
+                            guesses = chatdetails.get("guesses", {})
+                            first_guess = False
+                            del update_chat["guess_lock_until"], update_chat["guess_lock_started"]
+                            await update_room(chat_id, {"$set": update_chat})
+                    else:
+                        await update_room(chat_id, {"$set": update_chat})
 
                     user_update = {"$push": {"judged": chat_id}}
                     if correct:
                         user_update["$inc"] = {"score": score}
-                    await usersdb.update_one({"_id": data["username"]}, user_update)
+                    await leaderboard.update_user(data["username"], user_update)
                     await usersdb.update_one(
                         {"_id": data["username"], "active_chat": chat_id},
                         {"$unset": {"active_chat": ""}}
@@ -731,10 +1067,10 @@ async def routerjudgement(request: Request, chat_id: str, judgement: str):
                                 base = score if correct else int(other_guess.get("score", 0))
                                 bonus = compute_bounty(base)
                                 if bonus > 0 and winner:
-                                    await usersdb.update_one({"_id": winner}, {"$inc": {"score": bonus}})
+                                    await leaderboard.update_user(winner, {"$inc": {"score": bonus}})
                                 if winner:
-                                    await chatsdb.update_one(
-                                        {"_id": chat_id},
+                                    await update_room(
+                                        chat_id,
                                         {"$set": {
                                             f"guesses.{winner}.bounty": bonus,
                                             f"guesses.{winner}.final_score": base + bonus,
@@ -742,8 +1078,8 @@ async def routerjudgement(request: Request, chat_id: str, judgement: str):
                                         }}
                                     )
                             else:
-                                await chatsdb.update_one(
-                                    {"_id": chat_id},
+                                await update_room(
+                                    chat_id,
                                     {"$set": {"guess_timeout_handled": True}}
                                 )
                             await clear_active_chat(chatdetails)
@@ -0,0 +1,32 @@
+"""
+AI work dispatch queue.
+
+Room writes that hand the turn to the AI put the room id here and the completion
+loop wakes on it, instead of polling Mongo for claimable rooms. With change streams
+rooms handed to the AI by another worker arrive through the event hub as well.
+"""
+
+import asyncio
+from core import partitions
+
+queue = asyncio.Queue()
+# ids waiting in the queue, so a room is queued at most once
+pending = set()
+
+
+def enqueue(chat_id):
+    if chat_id in pending:
+        return
+    pending.add(chat_id)
+    queue.put_nowait(chat_id)
+
+async def next_room(timeout: float):
+    """Wait up to timeout seconds for a room id, raises asyncio.TimeoutError."""
+    chat_id = await asyncio.wait_for(queue.get(), timeout)
+    pending.discard(chat_id)
+    return chat_id
+
+def on_room_change(chat_id, fields):
+    """Change stream watcher, registered by core.chat.start_ai_worker."""
+    if fields.get("first") == "AI" and fields.get("active", True) and partitions.owns(chat_id):
+        enqueue(chat_id)
@@ -0,0 +1,126 @@
+"""
+Room event hub behind /chat/{chat_id}/events.
+
+Write paths report the fields they touched and every subscriber of that room gets a
+small server-sent event. When Mongo supports change streams the hub is fed from the
+stream instead, so rooms written by another uvicorn worker still reach our clients.
+"""
+
+import asyncio
+import json
+from pymongo.errors import OperationFailure
+from config import chatsdb
+
+EVENT_QUEUE_SIZE = 32
+KEEPALIVE_SECONDS = 15
+RETRY_MILLISECONDS = 3000
+
+# chat_id -> set of subscriber queues
+subscribers = {}
+# called with (chat_id, fields) for every change seen on the change stream
+watchers = []
+relay_active = False
+
+
+def subscribe(chat_id):
+    queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+    subscribers.setdefault(chat_id, set()).add(queue)
+    return queue
+
+def unsubscribe(chat_id, queue):
+    queues = subscribers.get(chat_id)
+    if not queues:
+        return
+    queues.discard(queue)
+    if not queues:
+        subscribers.pop(chat_id, None)
+
+def update_fields(update):
+    """Flatten a Mongo update document into {field: new value}."""
+    fields = {}
+    for op, values in update.items():
+        for key, value in values.items():
+            fields[key] = None if op == "$unset" else value
+    return fields
+
+def room_events(fields):
+    events = {}
+    for key, value in fields.items():
+        root = key.split(".")[0]
+        if root == "messages":
+            events["message"] = {}
+        elif root in ("first", "turn_started"):
+            events["turn"] = {"turn_started": fields.get("turn_started")}
+        elif root in ("guesses", "guess_lock_until", "guess_lock_started", "guess_unlock_started"):
+            events["guess"] = {"guess_lock_until": fields.get("guess_lock_until")}
+        elif root == "active" and value is False:
+            events["closed"] = {}
+    return events
+
+def deliver(chat_id, fields):
+    queues = subscribers.get(chat_id)
+    if not queues:
+        return
+    events = room_events(fields)
+    for queue in list(queues):
+        for event, data in events.items():
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                # every event makes the client refresh, a full queue already will
+                pass
+
+def publish(chat_id, update):
+    # with the change stream running, our own writes come back through it
+    if relay_active:
+        return
+    deliver(chat_id, update_fields(update))
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream(request, chat_id):
+    queue = subscribe(chat_id)
+    try:
+        # without the relay, writes made on other workers never reach this stream and the client keeps polling fast
+        yield f"retry: {RETRY_MILLISECONDS}\n" + format_event("sync", {"relay": relay_active})
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield ": keepalive\n\n"
+                continue
+            yield format_event(event, data)
+    finally:
+        unsubscribe(chat_id, queue)
+
+async def relay_room_changes():
+    global relay_active
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update"]}}}]
+    while True:
+        try:
+            async with chatsdb.watch(pipeline) as changes:
+                relay_active = True
+                async for change in changes:
+                    if change["operationType"] == "insert":
+                        fields = change["fullDocument"]
+                    else:
+                        description = change.get("updateDescription", {})
+                        fields = dict(description.get("updatedFields", {}))
+                        for key in description.get("removedFields", []):
+                            fields[key] = None
+                    chat_id = change["documentKey"]["_id"]
+                    for watcher in watchers:
+                        watcher(chat_id, fields)
+                    deliver(chat_id, fields)
+        except OperationFailure as e:
+            # standalone mongod has no change streams, stay on local delivery
+            relay_active = False
+            print(f"Room change stream unavailable, using local events: {e}")
+            return
+        except Exception as e:
+            relay_active = False
+            print(f"Error in room change stream: {e}")
+            await asyncio.sleep(1)
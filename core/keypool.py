@@ -0,0 +1,100 @@
+"""
+Pool of provider API keys.
+
+Each key has a token bucket rate limit and is put on cooldown after a 429 or 5xx
+response (honouring Retry-After). acquire() hands out the available key with the
+fewest requests in flight, waiting when every key is throttled.
+"""
+
+import asyncio
+import time
+
+KEY_WAIT_STEP_SECONDS = 0.5
+
+
+class ApiKey:
+    def __init__(self, key: str, rate_per_second: float, burst: int):
+        self.key = key
+        self.rate = rate_per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.failures = 0
+        self.requests = 0
+        self.throttled = 0
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_in(self, now: float) -> float:
+        """Seconds until this key can take a request, 0 if it can now."""
+        self.refill(now)
+        wait = max(0.0, self.cooldown_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+
+class KeyPool:
+    def __init__(self, keys, rate_per_minute: float, burst: int, cooldown: float):
+        self.keys = [ApiKey(k, rate_per_minute / 60, burst) for k in keys]
+        self.cooldown = cooldown
+
+    def __len__(self):
+        return len(self.keys)
+
+    async def acquire(self, exclude=()) -> ApiKey:
+        while True:
+            now = time.monotonic()
+            waits = {k: k.ready_in(now) for k in self.keys if k not in exclude} or {k: k.ready_in(now) for k in self.keys}
+            ready = [k for k, wait in waits.items() if wait == 0]
+            if ready:
+                # nothing awaits between picking and taking, so concurrent callers spread fairly
+                key = min(ready, key=lambda k: (k.in_flight, -k.tokens))
+                key.tokens -= 1
+                key.in_flight += 1
+                key.requests += 1
+                return key
+            await asyncio.sleep(min(min(waits.values()), KEY_WAIT_STEP_SECONDS))
+
+    def release(self, key: ApiKey, status: int = None, retry_after: str = None):
+        """Return a key. status is the HTTP status, None when the request never got a response.
+
+        Only 429 and 5xx responses put the key on cooldown. Without a response (cancelled
+        by the turn budget or shutdown, a timeout, an unreachable provider) the key is not
+        to blame and every other key would fare the same, so it goes back untouched.
+        """
+        key.in_flight -= 1
+        if status is None:
+            return
+        if status < 400:
+            key.failures = 0
+            return
+        if status != 429 and status < 500:
+            return
+        if status == 429:
+            key.throttled += 1
+        delay = self.cooldown * 2 ** min(key.failures, 4)
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            pass
+        key.failures += 1
+        key.cooldown_until = max(key.cooldown_until, time.monotonic() + delay)
+
+    def stats(self):
+        now = time.monotonic()
+        return [
+            {
+                "key": "..." + k.key[-4:],
+                "in_flight": k.in_flight,
+                "requests": k.requests,
+                "throttled": k.throttled,
+                "cooldown": round(max(0.0, k.cooldown_until - now), 1),
+                "tokens": round(min(k.burst, k.tokens + (now - k.updated) * k.rate), 1),
+            }
+            for k in self.keys
+        ]
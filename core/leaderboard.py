@@ -0,0 +1,176 @@
+"""
+In-memory leaderboard.
+
+Ranked players are kept as a sorted list of (-score, lastpoint, username) keys, so the
+top k is a slice and a player's rank is a bisect. The list is rebuilt from the
+leaderboard index at startup and then kept current from score writes made through
+update_user, and from the users change stream for writes made by other workers.
+Without change streams it is rebuilt every LEADERBOARD_REBUILD_SECONDS instead.
+"""
+
+import asyncio
+import base64
+import json
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+from config import usersdb, IST
+
+LEADERBOARD_REBUILD_SECONDS = 60
+LEADERBOARD_FIELDS = {"score": 1, "lastpoint": 1, "type": 1, "banned": 1}
+
+# sorted (-score, lastpoint, username)
+keys = []
+# username -> its key in keys
+entries = {}
+tasks = []
+
+
+def user_key(user):
+    return (-user.get("score", 0), user.get("lastpoint", 0), user["_id"])
+
+def ranked(user) -> bool:
+    return user.get("type") == "user" and not user.get("banned")
+
+def remove(username):
+    key = entries.pop(username, None)
+    if key is None:
+        return
+    i = bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+        del keys[i]
+
+def apply(user):
+    """Put the user at their current place, or take them off the board."""
+    remove(user["_id"])
+    if ranked(user):
+        key = user_key(user)
+        entries[user["_id"]] = key
+        insort(keys, key)
+
+def row(key, rank=None):
+    entry = {"username": key[2], "score": -key[0], "lastpoint": key[1]}
+    if rank is not None:
+        entry["rank"] = rank
+    return entry
+
+def top(k: int):
+    return [row(key) for key in keys[:k]]
+
+def encode_cursor(key) -> str:
+    return base64.urlsafe_b64encode(json.dumps([-key[0], key[1], key[2]]).encode()).decode()
+
+def decode_cursor(cursor: str):
+    """Key for a cursor from encode_cursor, raises ValueError when it is malformed."""
+    try:
+        score, lastpoint, username = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError(f"Invalid leaderboard cursor: {cursor}")
+    # the key is compared against the board's keys, so its fields must have their types
+    numbers = all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in (score, lastpoint))
+    if not numbers or not isinstance(username, str):
+        raise ValueError(f"Invalid leaderboard cursor: {cursor}")
+    return (-score, lastpoint, username)
+
+def page(after=None, limit: int = 50):
+    """limit ranked rows after the key `after`, from the top without one, and the cursor of the next page."""
+    start = bisect_right(keys, after) if after else 0
+    chunk = keys[start:start + limit]
+    rows = [row(key, start + i + 1) for i, key in enumerate(chunk)]
+    more = start + limit < len(keys)
+    return rows, (encode_cursor(chunk[-1]) if chunk and more else None)
+
+def around(username, neighbours: int):
+    """The player's row with up to `neighbours` rows above and below, empty when they are not ranked."""
+    position = rank(username)
+    if position is None:
+        return []
+    start = max(0, position - 1 - neighbours)
+    return [row(key, start + i + 1) for i, key in enumerate(keys[start:position + neighbours])]
+
+def rank(username):
+    """1-based rank, None for players not on the board."""
+    key = entries.get(username)
+    if key is None:
+        return None
+    return bisect_left(keys, key) + 1
+
+async def update_user(username, update):
+    """Write an update that may change the user's score and move them on the board."""
+    if update.get("$inc", {}).get("score"):
+        # lastpoint breaks ties: whoever reached the score first ranks higher
+        update = {**update, "$set": {**update.get("$set", {}), "lastpoint": datetime.now(IST).timestamp()}}
+    user = await usersdb.find_one_and_update(
+        {"_id": username},
+        update,
+        projection=LEADERBOARD_FIELDS,
+        return_document=ReturnDocument.AFTER
+    )
+    if user:
+        apply(user)
+    return user
+
+async def refresh_user(username):
+    user = await usersdb.find_one({"_id": username}, LEADERBOARD_FIELDS)
+    if user:
+        apply(user)
+    else:
+        remove(username)
+
+async def rebuild():
+    users = usersdb.find({"type": "user", "banned": False}, LEADERBOARD_FIELDS).sort([("score", -1), ("lastpoint", 1)])
+    fresh = {}
+    async for user in users:
+        fresh[user["_id"]] = user_key(user)
+    keys[:] = sorted(fresh.values())
+    entries.clear()
+    entries.update(fresh)
+
+async def follow_changes():
+    pipeline = [{"$match": {"$or": [
+        {"operationType": {"$in": ["insert", "replace", "delete"]}},
+        {"updateDescription.updatedFields.score": {"$exists": True}},
+        {"updateDescription.updatedFields.lastpoint": {"$exists": True}},
+        {"updateDescription.updatedFields.banned": {"$exists": True}},
+    ]}}]
+    async with usersdb.watch(pipeline, full_document="updateLookup") as changes:
+        # anything written between the rebuild and the stream opening is caught by this rebuild
+        await rebuild()
+        async for change in changes:
+            user = change.get("fullDocument")
+            if user:
+                apply(user)
+            else:
+                remove(change["documentKey"]["_id"])
+
+async def run():
+    while True:
+        try:
+            await follow_changes()
+        except OperationFailure as e:
+            print(f"Users change stream unavailable, rebuilding the leaderboard periodically: {e}")
+            break
+        except Exception as e:
+            print(f"Error following leaderboard changes: {e}")
+            await asyncio.sleep(1)
+    while True:
+        try:
+            await rebuild()
+        except Exception as e:
+            print(f"Error rebuilding leaderboard: {e}")
+        await asyncio.sleep(LEADERBOARD_REBUILD_SECONDS)
+
+async def start():
+    """Build the board before serving requests, then keep it current in the background."""
+    try:
+        await rebuild()
+    except Exception as e:
+        print(f"Error building leaderboard: {e}")
+    tasks.append(asyncio.create_task(run()))
+
+async def stop():
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    tasks.clear()
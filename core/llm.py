@@ -0,0 +1,278 @@
+"""
+LLM completion backends and the shared HTTP client they use.
+
+One pooled client per worker keeps connections to the provider alive between turns,
+so a reply does not pay DNS, TCP and TLS setup every time. app.py opens it at startup
+and closes it at shutdown.
+
+LLM_BACKEND picks the backend: "openrouter" talks to the provider through the key
+pool, "fake" answers in-process with canned replies after a simulated latency and
+fails at a configured rate, for load testing the AI path without network or spend.
+
+Each AI worker keeps its breaker state in the shared llm_breaker doc in leasesdb, so the
+matchmaker sheds AI rooms even when replies are generated by standalone workers.
+"""
+
+import asyncio
+import importlib.util
+import json
+import random
+import time
+import zlib
+import httpx
+from config import (
+    leasesdb, LLM_HTTP2, LLM_STREAMING, LLM_BACKEND, LLM_URL, LLM_MODEL,
+    APIKEYS, APIKEY_RATE_PER_MINUTE, APIKEY_BURST, APIKEY_COOLDOWN_SECONDS,
+    FAKE_LLM_LATENCY, FAKE_LLM_ERROR_RATE, FAKE_LLM_REPLIES, FAKE_LLM_SEED
+)
+from core.keypool import KeyPool
+from core.breaker import CircuitBreaker, CircuitOpen
+from core.partitions import worker_id
+
+LLM_MAX_CONNECTIONS = 100
+LLM_MAX_KEEPALIVE = 20
+LLM_KEEPALIVE_EXPIRY = 60
+LLM_CONNECT_TIMEOUT = 5
+BREAKER_SYNC_SECONDS = 1
+
+http_client = None
+# shared by the completion loop and matchmaking, which stops handing out AI rooms while it is open
+breaker = CircuitBreaker()
+# latest epoch any AI worker's breaker is open until, as last read from the llm_breaker doc
+shared_open_until = 0.0
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+def open_http_client(timeout: float):
+    global http_client
+    if http_client is None:
+        http2 = LLM_HTTP2 and http2_available()
+        if LLM_HTTP2 and not http2:
+            print("LLM_HTTP2 is set but h2 is not installed, using HTTP/1.1")
+        http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(timeout, connect=LLM_CONNECT_TIMEOUT)
+        )
+    return http_client
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
+def word_count(text: str) -> int:
+    return len(text.split())
+
+async def read_completion_stream(response, started: float, word_limit: int = None):
+    """Read an SSE completion until it ends or passes word_limit. Returns (text, time to first token)."""
+    text = ""
+    ttft = None
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        chunk = json.loads(data)
+        if "error" in chunk:
+            raise RuntimeError(f"Completion stream error: {chunk['error']}")
+        delta = chunk["choices"][0].get("delta", {}).get("content") or ""
+        if delta and ttft is None:
+            ttft = time.monotonic() - started
+        text += delta
+        # one word past the limit means the last kept word is complete
+        if word_limit and word_count(text) > word_limit:
+            break
+    return text, ttft or (time.monotonic() - started)
+
+
+class CompletionBackend:
+    name = "base"
+
+    async def complete(self, messages, max_tokens: int, word_limit: int = None):
+        """Returns (text, time to first token in seconds) for the chat messages."""
+        raise NotImplementedError
+
+    def stats(self):
+        return {"backend": self.name}
+
+
+class OpenRouterBackend(CompletionBackend):
+    name = "openrouter"
+
+    def __init__(self, keys: KeyPool, timeout: float, url: str = LLM_URL, model: str = LLM_MODEL, streaming: bool = LLM_STREAMING):
+        self.keys = keys
+        self.timeout = timeout
+        self.url = url
+        self.model = model
+        self.streaming = streaming
+
+    async def complete(self, messages, max_tokens: int, word_limit: int = None):
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": max_tokens
+        }
+        if self.streaming:
+            payload["stream"] = True
+
+        client = open_http_client(self.timeout)
+        tried = []
+        while True:
+            key = await self.keys.acquire(exclude=tried)
+            tried.append(key)
+            status = None
+            retry_after = None
+            try:
+                headers = {
+                    "Authorization": f"Bearer {key.key}",
+                    "Content-Type": "application/json"
+                }
+                started = time.monotonic()
+                if self.streaming:
+                    # leaving the block closes the stream, so a cut-off reply stops generating
+                    async with client.stream("POST", self.url, json=payload, headers=headers) as response:
+                        status = response.status_code
+                        retry_after = response.headers.get("retry-after")
+                        if status >= 400:
+                            await response.aread()
+                        response.raise_for_status()
+                        return await read_completion_stream(response, started, word_limit)
+                response = await client.post(self.url, json=payload, headers=headers)
+                status = response.status_code
+                retry_after = response.headers.get("retry-after")
+                response.raise_for_status()  # Raise an exception for HTTP errors
+                resp = response.json()
+                return resp["choices"][0]["message"]["content"], time.monotonic() - started
+            except httpx.HTTPStatusError:
+                # throttled or failing: fail over to a key we have not tried yet. Timeouts and
+                # connection errors are not the key's fault and go to the caller's retry instead.
+                if len(tried) >= len(self.keys) or (status != 429 and status < 500):
+                    raise
+            finally:
+                self.keys.release(key, status, retry_after)
+
+    def stats(self):
+        return {"backend": self.name, "api_keys": self.keys.stats()}
+
+
+FAKE_REPLIES = [
+    "hey whats up",
+    "lol same honestly",
+    "idk man, kinda tired today",
+    "haha thats fair. where are you from?",
+    "nah not really, you?",
+    "hmm good question tbh",
+]
+
+def parse_latency(spec: str):
+    """Sampler for a latency spec like fixed:1.5, uniform:0.5,3 or lognormal:<median>,<sigma> (seconds)."""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v.strip()]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda rng: median * rng.lognormvariate(0, sigma)
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FakeBackend(CompletionBackend):
+    """In-process provider. The same conversation always gets the same reply; latency and errors come from a seeded RNG."""
+    name = "fake"
+
+    def __init__(self, latency: str = FAKE_LLM_LATENCY, error_rate: float = FAKE_LLM_ERROR_RATE, replies=None, seed: int = FAKE_LLM_SEED):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.replies = replies or FAKE_REPLIES
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+
+    async def complete(self, messages, max_tokens: int, word_limit: int = None):
+        self.calls += 1
+        self.in_flight += 1
+        try:
+            delay = self.latency(self.rng)
+            failed = self.rng.random() < self.error_rate
+            await asyncio.sleep(delay)
+            if failed:
+                self.errors += 1
+                request = httpx.Request("POST", LLM_URL)
+                status = self.rng.choice([429, 500, 503])
+                raise httpx.HTTPStatusError(f"Fake provider error {status}", request=request, response=httpx.Response(status, request=request))
+            transcript = "\n".join(m.get("content", "") for m in messages)
+            reply = self.replies[zlib.crc32(transcript.encode()) % len(self.replies)]
+            return reply, delay
+        finally:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {"backend": self.name, "calls": self.calls, "errors": self.errors, "in_flight": self.in_flight}
+
+
+def load_replies(path: str):
+    if not path:
+        return None
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def create_backend(timeout: float) -> CompletionBackend:
+    if LLM_BACKEND == "fake":
+        return FakeBackend(replies=load_replies(FAKE_LLM_REPLIES))
+    if LLM_BACKEND == "openrouter":
+        return OpenRouterBackend(KeyPool(APIKEYS, APIKEY_RATE_PER_MINUTE, APIKEY_BURST, APIKEY_COOLDOWN_SECONDS), timeout)
+    raise ValueError(f"Unknown LLM_BACKEND: {LLM_BACKEND}")
+
+async def guarded_complete(backend: CompletionBackend, messages, max_tokens: int, word_limit: int = None, timeout: float = None):
+    """backend.complete through the circuit breaker, raises CircuitOpen while the breaker refuses calls."""
+    if not breaker.allow():
+        raise CircuitOpen("LLM circuit breaker is open")
+    started = time.monotonic()
+    ok = False
+    try:
+        result = await asyncio.wait_for(backend.complete(messages, max_tokens, word_limit), timeout)
+        ok = True
+        return result
+    finally:
+        breaker.record(ok, time.monotonic() - started)
+
+def ai_shed() -> bool:
+    """True while AI rooms should not be handed out: this worker's breaker or an AI worker's is open."""
+    return breaker.is_open() or shared_open_until > time.time()
+
+async def publish_breaker():
+    """AI workers: keep open_until.<worker_id> in the llm_breaker doc while this worker's breaker is open."""
+    published = None
+    while True:
+        state = breaker.opened_at if breaker.is_open() else None
+        if state != published:
+            try:
+                if state is None:
+                    update = {"$unset": {f"open_until.{worker_id}": ""}}
+                else:
+                    open_until = time.time() + breaker.retry_at() - time.monotonic()
+                    update = {"$set": {f"open_until.{worker_id}": open_until}}
+                await leasesdb.update_one({"_id": "llm_breaker"}, update, upsert=True)
+                published = state
+            except Exception as e:
+                print(f"Error publishing LLM breaker state: {e}")
+        await asyncio.sleep(BREAKER_SYNC_SECONDS)
+
+async def refresh_shared_breaker():
+    """Read the AI workers' breakers; entries of workers that died while open simply run out."""
+    global shared_open_until
+    doc = await leasesdb.find_one({"_id": "llm_breaker"})
+    shared_open_until = max((doc or {}).get("open_until", {}).values(), default=0.0)
@@ -0,0 +1,255 @@
+"""
+Matchmaking service.
+
+One web worker at a time holds the matchmaker lease and does all the pairing. Joining
+only marks the user as queueing (matchmaking: true, match_target, match_since); the
+leader takes joins on its own worker straight away and finds the rest with one scan
+every MATCH_SCAN_SECONDS, however many players are polling.
+
+Players heading for an AI room get it as soon as the leader sees them. Players looking
+for a human wait in a FIFO queue and are paired the moment a second one arrives; if
+nobody does within HUMAN_FALLBACK_SECONDS they are given an AI room instead. Only the
+pairing is written: each user moving into the room, then the room itself.
+
+Long-polling /api/match-status requests wait on wait_for_match, which is woken by the
+pairing on this worker or by the new room arriving through the change stream.
+"""
+
+import asyncio
+from collections import OrderedDict
+from datetime import datetime
+from random import random
+from uuid import uuid4
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from config import usersdb, leasesdb, IST
+from core.prompts import CURRENT_PROMPT
+from core.rooms import insert_room
+from core.scheduler import DeadlineScheduler
+from core.partitions import worker_id
+from core import llm, events
+
+MATCH_LEASE_SECONDS = 10
+MATCH_SCAN_SECONDS = 1
+# the old matcher fell back to AI after three missed 3 s polls
+HUMAN_FALLBACK_SECONDS = 9
+# while an LLM breaker is open (here or on any AI worker) nobody is sent to an AI room, fallbacks are retried this often
+AI_SHED_RETRY_SECONDS = 5
+# users are moved before their room is inserted; a room missing for longer than this is not coming
+ROOM_INSERT_GRACE_SECONDS = 10
+
+leader = False
+# username -> time the user joined the queue, oldest first
+human_queue = OrderedDict()
+# users whose pairing writes are in progress
+assigning = set()
+# pairing writes in flight, held so the loop does not collect them mid-run
+pairing_tasks = set()
+# called with (username, chat_id) once a user has been moved into a room
+match_hooks = []
+tasks = []
+# username -> events of the match-status requests waiting for that user
+waiters = {}
+
+
+def now_ts() -> float:
+    return datetime.now(IST).timestamp()
+
+def wake(username):
+    for event in waiters.get(username, ()):
+        event.set()
+
+def wakes_reliably() -> bool:
+    """True when every pairing reaches wait_for_match without polling Mongo."""
+    return leader or events.relay_active
+
+async def wait_for_match(username, timeout: float):
+    """Return once username may have been matched, or after timeout seconds."""
+    event = asyncio.Event()
+    waiters.setdefault(username, set()).add(event)
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        waiters[username].discard(event)
+        if not waiters[username]:
+            del waiters[username]
+
+def on_room_change(chat_id, fields):
+    # only inserts carry user1, i.e. a room the leader on another worker just created
+    if "user1" in fields:
+        wake(fields["user1"])
+        wake(fields.get("user2"))
+
+events.watchers.append(on_room_change)
+
+def matched(username, chat_id):
+    wake(username)
+    for hook in match_hooks:
+        hook(username, chat_id)
+
+async def move_into_room(username, chat_id) -> bool:
+    """Take the user out of the queue into chat_id; False if they already left it or were matched elsewhere."""
+    result = await usersdb.update_one(
+        {"_id": username, "matchmaking": True},
+        {
+            "$set": {"matchmaking": False, "active_chat": chat_id, "matched_at": now_ts()},
+            "$unset": {"match_target": "", "match_since": ""}
+        }
+    )
+    return result.modified_count == 1
+
+def room_pending(user) -> bool:
+    """The user was just moved into a room the pairing has not inserted yet."""
+    return bool(user.get("active_chat")) and now_ts() - user.get("matched_at", 0) < ROOM_INSERT_GRACE_SECONDS
+
+async def create_ai_room(username):
+    chat_id = str(uuid4())
+    if not await move_into_room(username, chat_id):
+        return
+    now = now_ts()
+    await insert_room({
+        "_id": chat_id,
+        "messages": [],
+        "prompt": CURRENT_PROMPT,
+        "user1": username,
+        "user2": "AI",
+        "time": now,
+        "active": True,
+        "first": ("AI" if random() < 0.5 else username),
+        "turn_started": now
+    })
+    matched(username, chat_id)
+
+async def create_human_room(user1, user2):
+    chat_id = str(uuid4())
+    if not await move_into_room(user1, chat_id):
+        requeue(user2)
+        return
+    if not await move_into_room(user2, chat_id):
+        # put user1 back where they were instead of leaving them in a room alone
+        await usersdb.update_one(
+            {"_id": user1, "active_chat": chat_id},
+            {"$set": {"matchmaking": True, "active_chat": None, "match_target": "Human", "match_since": now_ts()}}
+        )
+        requeue(user1)
+        return
+    await insert_room({
+        "_id": chat_id,
+        "messages": [],
+        "user1": user1,
+        "user2": user2,
+        "time": now_ts(),
+        "active": True,
+    })
+    matched(user1, chat_id)
+    matched(user2, chat_id)
+
+async def assign(coro, usernames):
+    try:
+        await coro
+    except Exception as e:
+        print(f"Error matching {', '.join(usernames)}: {e}")
+    finally:
+        assigning.difference_update(usernames)
+
+def spawn(coro, *usernames):
+    # marked before the task starts, so a join in between cannot queue them again
+    assigning.update(usernames)
+    task = asyncio.create_task(assign(coro, usernames))
+    pairing_tasks.add(task)
+    task.add_done_callback(pairing_tasks.discard)
+
+def requeue(username):
+    """Put a user whose partner fell through back at the front of the queue."""
+    human_queue[username] = now_ts()
+    human_queue.move_to_end(username, last=False)
+    fallbacks.schedule(username, now_ts() + HUMAN_FALLBACK_SECONDS)
+
+def join(username, target):
+    """Queue a user for pairing. Only the leader pairs, on other workers this does nothing."""
+    if not leader or username in human_queue or username in assigning:
+        return
+    if target == "AI" and not llm.ai_shed():
+        spawn(create_ai_room(username), username)
+        return
+    # AI-bound players look for a human while the breaker sheds AI rooms
+    if human_queue:
+        partner, _ = human_queue.popitem(last=False)
+        fallbacks.cancel(partner)
+        spawn(create_human_room(partner, username), partner, username)
+        return
+    human_queue[username] = now_ts()
+    fallbacks.schedule(username, now_ts() + HUMAN_FALLBACK_SECONDS)
+
+async def fallback_to_ai(username):
+    if username not in human_queue:
+        return
+    if llm.ai_shed():
+        fallbacks.schedule(username, now_ts() + AI_SHED_RETRY_SECONDS)
+        return
+    del human_queue[username]
+    spawn(create_ai_room(username), username)
+
+fallbacks = DeadlineScheduler(fallback_to_ai)
+
+async def scan():
+    """Join every queueing user the leader has not seen yet and forget the ones who left."""
+    started = now_ts()
+    seen = set()
+    queueing = usersdb.find({"matchmaking": True, "banned": False}, {"match_target": 1}).sort("match_since", 1)
+    async for user in queueing:
+        seen.add(user["_id"])
+        join(user["_id"], user.get("match_target") or "Human")
+    for username, joined in list(human_queue.items()):
+        if username not in seen and joined < started:
+            del human_queue[username]
+            fallbacks.cancel(username)
+
+def step_down():
+    global leader
+    leader = False
+    for username in human_queue:
+        fallbacks.cancel(username)
+    human_queue.clear()
+
+async def run():
+    global leader
+    while True:
+        try:
+            now = now_ts()
+            try:
+                lease = await leasesdb.find_one_and_update(
+                    {"_id": "matchmaker", "$or": [{"owner": worker_id}, {"lease_until": {"$lt": now}}]},
+                    {"$set": {"owner": worker_id, "lease_until": now + MATCH_LEASE_SECONDS}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+            except DuplicateKeyError:
+                # another worker holds the lease
+                lease = None
+            if lease:
+                leader = True
+                await llm.refresh_shared_breaker()
+                await scan()
+            elif leader:
+                step_down()
+        except Exception as e:
+            print(f"Error in matchmaking: {e}")
+        await asyncio.sleep(MATCH_SCAN_SECONDS)
+
+def start():
+    tasks.extend([
+        asyncio.create_task(run()),
+        asyncio.create_task(fallbacks.run()),
+    ])
+
+async def stop():
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    tasks.clear()
+    if leader:
+        step_down()
+        await leasesdb.update_one({"_id": "matchmaker", "owner": worker_id}, {"$set": {"lease_until": 0}})
@@ -0,0 +1,79 @@
+"""
+Pre-generated opening lines for AI rooms where the AI speaks first.
+
+A background task keeps a few openers per prompt version ready, so the first AI
+message only waits for the simulated typing delay instead of a completion round trip.
+Openers older than OPENER_MAX_AGE_SECONDS are dropped so players do not keep seeing
+the same lines, and pools of prompt versions no longer handed out are cleared.
+"""
+
+import asyncio
+import time
+from collections import deque
+from core.prompts import CURRENT_PROMPT
+
+OPENER_POOL_SIZE = 8
+OPENER_MAX_AGE_SECONDS = 600
+OPENER_REFILL_SECONDS = 30
+OPENER_RETRY_SECONDS = 5
+
+# prompt id -> deque of (created monotonic time, text)
+pools = {}
+stats = {"hits": 0, "misses": 0, "evicted": 0, "generated": 0}
+refill_needed = asyncio.Event()
+
+
+def evict_stale(prompt_id):
+    pool = pools.get(prompt_id)
+    if not pool:
+        return
+    cutoff = time.monotonic() - OPENER_MAX_AGE_SECONDS
+    while pool and pool[0][0] < cutoff:
+        pool.popleft()
+        stats["evicted"] += 1
+
+def take(prompt_id=None):
+    """An unused opener for the prompt version, or None when the pool is empty."""
+    prompt_id = prompt_id or CURRENT_PROMPT
+    evict_stale(prompt_id)
+    pool = pools.get(prompt_id)
+    if not pool:
+        stats["misses"] += 1
+        refill_needed.set()
+        return None
+    stats["hits"] += 1
+    refill_needed.set()
+    return pool.popleft()[1]
+
+def opener_stats():
+    return {
+        **stats,
+        "pooled": {prompt_id: len(pool) for prompt_id, pool in pools.items()},
+    }
+
+async def refill(generate, prompt_id):
+    pool = pools.setdefault(prompt_id, deque())
+    evict_stale(prompt_id)
+    while len(pool) < OPENER_POOL_SIZE:
+        text = await generate(prompt_id)
+        if text:
+            pool.append((time.monotonic(), text))
+            stats["generated"] += 1
+
+async def run(generate):
+    """Keep the pool of the current prompt version full; generate(prompt_id) returns an opener."""
+    while True:
+        for prompt_id in list(pools):
+            if prompt_id != CURRENT_PROMPT:
+                stats["evicted"] += len(pools.pop(prompt_id))
+        refill_needed.clear()
+        try:
+            await refill(generate, CURRENT_PROMPT)
+        except Exception as e:
+            print(f"Error refilling openers: {e}")
+            await asyncio.sleep(OPENER_RETRY_SECONDS)
+            continue
+        try:
+            await asyncio.wait_for(refill_needed.wait(), OPENER_REFILL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,111 @@
+"""
+Hash partitioned ownership of AI rooms.
+
+AI rooms get a partition from their id when they are created. Every AI worker
+heartbeats into the workers collection and holds leases on roughly an equal share of
+the AI_PARTITIONS partitions in the partitions collection, and only claims rooms in
+the partitions it owns, so workers no longer race on the same documents. Leases of a
+worker that stops renewing them run out after PARTITION_LEASE_SECONDS and the
+remaining workers take its partitions over.
+
+Ownership relies on the change stream to hear about rooms written by other workers;
+without one every worker claims from every partition as before.
+"""
+
+import asyncio
+import math
+import os
+import socket
+import zlib
+from datetime import datetime
+from uuid import uuid4
+from pymongo.errors import BulkWriteError
+from config import partitionsdb, workersdb, IST, AI_PARTITIONS
+from core import events
+
+PARTITION_LEASE_SECONDS = 15
+PARTITION_RENEW_SECONDS = 5
+
+worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:6]}"
+owned = set()
+# called after new partitions were taken over, so their waiting rooms get claimed
+acquire_hooks = []
+
+
+def partition_of(chat_id) -> int:
+    return zlib.crc32(str(chat_id).encode()) % AI_PARTITIONS
+
+def enabled() -> bool:
+    return events.relay_active
+
+def owns(chat_id) -> bool:
+    return not enabled() or partition_of(chat_id) in owned
+
+def claim_filter():
+    """Extra room filter restricting claims to our partitions."""
+    if not enabled():
+        return {}
+    mine = sorted(owned)
+    if 0 in owned:
+        # rooms created before partitioning have no partition field, partition 0 looks after them
+        return {"$or": [{"partition": {"$in": mine}}, {"partition": {"$exists": False}}]}
+    return {"partition": {"$in": mine}}
+
+async def ensure_partitions():
+    try:
+        await partitionsdb.insert_many(
+            [{"_id": p, "owner": None, "lease_until": 0} for p in range(AI_PARTITIONS)],
+            ordered=False
+        )
+    except BulkWriteError:
+        # already created by another worker
+        pass
+
+async def rebalance():
+    now = datetime.now(IST).timestamp()
+    lease_until = now + PARTITION_LEASE_SECONDS
+    await workersdb.update_one({"_id": worker_id}, {"$set": {"seen": now}}, upsert=True)
+    live = await workersdb.count_documents({"seen": {"$gt": now - PARTITION_LEASE_SECONDS}})
+    share = math.ceil(AI_PARTITIONS / max(1, live))
+
+    await partitionsdb.update_many(
+        {"_id": {"$in": list(owned)}, "owner": worker_id},
+        {"$set": {"lease_until": lease_until}}
+    )
+    held = [p["_id"] async for p in partitionsdb.find({"owner": worker_id, "lease_until": {"$gt": now}}, {"_id": 1})]
+    owned.clear()
+    owned.update(held)
+
+    # give up extras so a worker that just joined can take its share
+    for p in sorted(owned)[share:]:
+        await partitionsdb.update_one({"_id": p, "owner": worker_id}, {"$set": {"owner": None, "lease_until": 0}})
+        owned.discard(p)
+
+    acquired = False
+    while len(owned) < share:
+        p = await partitionsdb.find_one_and_update(
+            {"_id": {"$nin": list(owned)}, "$or": [{"owner": None}, {"lease_until": {"$lt": now}}]},
+            {"$set": {"owner": worker_id, "lease_until": lease_until}}
+        )
+        if not p:
+            break
+        owned.add(p["_id"])
+        acquired = True
+    if acquired:
+        for hook in acquire_hooks:
+            hook()
+
+async def run():
+    await ensure_partitions()
+    while True:
+        try:
+            await rebalance()
+        except Exception as e:
+            print(f"Error rebalancing AI partitions: {e}")
+        await asyncio.sleep(PARTITION_RENEW_SECONDS)
+
+async def release_all():
+    """Hand our partitions back at shutdown instead of letting the leases run out."""
+    await partitionsdb.update_many({"owner": worker_id}, {"$set": {"owner": None, "lease_until": 0}})
+    await workersdb.delete_one({"_id": worker_id})
+    owned.clear()
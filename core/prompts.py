@@ -53,3 +53,15 @@ STYLE_PROMPT = (
     "Avoid AI-style disclaimers. "
     "If the user is silent, do not monologue."
 )
+
+
+# Rooms store the id of the prompt they were started with instead of the prompt text.
+# Add a new id when the prompts change so running rooms keep theirs.
+PROMPTS = {
+    "v1": {"ai": AI_PROMPT, "style": STYLE_PROMPT},
+}
+CURRENT_PROMPT = "v1"
+
+
+def get_prompt(prompt_id=None):
+    return PROMPTS.get(prompt_id) or PROMPTS[CURRENT_PROMPT]
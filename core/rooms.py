@@ -0,0 +1,112 @@
+"""
+Shared read/write path for chat rooms.
+
+Every room write goes through update_room, which bumps the room's version `v`,
+notifies the event hub and write hooks (deadline scheduling) and keeps a small
+per-worker cache of hot rooms current.
+Cached rooms are revalidated against Mongo by version once they are older than the
+TTL, and dropped early when the change stream reports a newer version from another
+worker.
+"""
+
+import time
+from collections import OrderedDict
+from pymongo import ReturnDocument
+from config import chatsdb
+from core import events
+from core.partitions import partition_of
+
+ROOM_CACHE_SIZE = 2000
+# without the change stream other workers' writes are only seen on revalidation
+ROOM_CACHE_TTL = 2
+ROOM_CACHE_TTL_WATCHED = 60
+
+
+class RoomCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, chat_id):
+        entry = self.entries.get(chat_id)
+        if entry:
+            self.entries.move_to_end(chat_id)
+        return entry
+
+    def put(self, room):
+        self.entries[room["_id"]] = (time.monotonic(), room)
+        self.entries.move_to_end(room["_id"])
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def touch(self, chat_id):
+        entry = self.entries.get(chat_id)
+        if entry:
+            self.entries[chat_id] = (time.monotonic(), entry[1])
+
+    def drop(self, chat_id):
+        self.entries.pop(chat_id, None)
+
+
+room_cache = RoomCache(ROOM_CACHE_SIZE)
+# called with the room after every insert or update made through this module
+write_hooks = []
+
+
+def cache_room(room):
+    if room:
+        room_cache.put(room)
+    return room
+
+def room_written(room):
+    cache_room(room)
+    for hook in write_hooks:
+        hook(room)
+
+async def get_room(chat_id):
+    """Room document for chat_id, from the cache when it is still current. Returns a copy callers may modify."""
+    entry = room_cache.get(chat_id)
+    if entry:
+        checked_at, room = entry
+        ttl = ROOM_CACHE_TTL_WATCHED if events.relay_active else ROOM_CACHE_TTL
+        if time.monotonic() - checked_at < ttl:
+            return dict(room)
+        newer = await chatsdb.find_one({"_id": chat_id, "v": {"$ne": room.get("v")}})
+        if not newer:
+            room_cache.touch(chat_id)
+            return dict(room)
+        return dict(cache_room(newer))
+    room = await chatsdb.find_one({"_id": chat_id})
+    return dict(cache_room(room)) if room else None
+
+async def insert_room(room):
+    room.setdefault("v", 0)
+    # per-side message counters, kept in step by core.chat.message_update
+    for counter in ("count_user1", "count_user2", "words_user1", "words_user2", "message_count"):
+        room.setdefault(counter, 0)
+    if room.get("user2") == "AI":
+        room.setdefault("partition", partition_of(room["_id"]))
+    await chatsdb.insert_one(room)
+    room_written(dict(room))
+
+async def update_room(chat_id, update, match=None):
+    """Apply update to the room and return the room after it, or None if match did not hold."""
+    update = {**update, "$inc": {**update.get("$inc", {}), "v": 1}}
+    room = await chatsdb.find_one_and_update(
+        {"_id": chat_id, **(match or {})},
+        update,
+        return_document=ReturnDocument.AFTER
+    )
+    if not room:
+        room_cache.drop(chat_id)
+        return None
+    room_written(room)
+    events.publish(chat_id, update)
+    return room
+
+def on_room_change(chat_id, fields):
+    entry = room_cache.get(chat_id)
+    if entry and fields.get("v", 0) > entry[1].get("v", 0):
+        room_cache.drop(chat_id)
+
+events.watchers.append(on_room_change)
@@ -0,0 +1,65 @@
+"""
+Heap based deadline scheduler.
+
+Each key has at most one pending deadline; scheduling a key again replaces it, and
+stale heap entries are skipped when they surface. Deadlines are epoch timestamps,
+like the ones stored on rooms.
+"""
+
+import asyncio
+import heapq
+import time
+
+
+class DeadlineScheduler:
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        self.deadlines = {}
+        self.wakeup = asyncio.Event()
+        # callbacks in flight, held so the loop does not collect them mid-run
+        self.tasks = set()
+
+    def schedule(self, key, when):
+        if when is None:
+            self.cancel(key)
+            return
+        if self.deadlines.get(key) == when:
+            return
+        self.deadlines[key] = when
+        heapq.heappush(self.heap, (when, key))
+        if len(self.heap) > 2 * len(self.deadlines) + 1024:
+            self.heap = [(w, k) for k, w in self.deadlines.items()]
+            heapq.heapify(self.heap)
+        if self.heap[0] == (when, key):
+            self.wakeup.set()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    async def fire(self, key):
+        try:
+            await self.callback(key)
+        except Exception as e:
+            print(f"Error firing deadline for {key}: {e}")
+
+    async def run(self):
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                when, key = heapq.heappop(self.heap)
+                if self.deadlines.get(key) != when:
+                    continue
+                del self.deadlines[key]
+                task = asyncio.create_task(self.fire(key))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            timeout = self.heap[0][0] - now if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,53 @@
+"""
+Per-request session for page and API routes.
+
+get_session is a FastAPI dependency that verifies the token cookie and, for players,
+resolves their active room through users.active_chat: one projected point read on
+users plus the room itself, usually straight from the room cache, instead of scanning
+chats for the user.
+"""
+
+from fastapi import Request
+from config import verify_jwt, usersdb
+from core.rooms import get_room
+
+# judged is appended to, so the active room shows up among the last entries if it was judged
+RECENT_JUDGED = 10
+
+
+class Session:
+    def __init__(self, username: str, type: str, user=None):
+        self.username = username
+        self.type = type
+        # projected user document, players only
+        self.user = user
+        self.room = None
+        self.judged = False
+
+    @property
+    def unjudged_room(self):
+        """Active room the player still has to finish or judge."""
+        return self.room if self.room and not self.judged else None
+
+
+async def get_session(request: Request):
+    """None without a valid token cookie."""
+    token = request.cookies.get("token")
+    if not token:
+        return None
+    data = verify_jwt(token)
+    if not data:
+        return None
+    if data["type"] != "user":
+        return Session(data["username"], data["type"])
+    user = await usersdb.find_one(
+        {"_id": data["username"]},
+        {"active_chat": 1, "matched_at": 1, "matchmaking": 1, "match_target": 1, "judged": {"$slice": -RECENT_JUDGED}}
+    )
+    session = Session(data["username"], data["type"], user)
+    if user and user.get("active_chat"):
+        room = await get_room(user["active_chat"])
+        if room and room.get("active"):
+            session.room = room["_id"]
+            session.judged = room["_id"] in user.get("judged", [])
+    return session
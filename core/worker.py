@@ -0,0 +1,34 @@
+"""
+Standalone AI worker: python -m core.worker
+
+Runs the AI completion loop without serving HTTP, so AI workers can be scaled apart
+from the uvicorn web workers (set AI_WORKER_IN_PROCESS=false for those). Rooms are
+picked up from the Mongo change stream, or by sweeping for claimable rooms when the
+database has no change streams. SIGTERM/SIGINT stop claiming and drain in-flight
+replies before exiting.
+"""
+
+import asyncio
+import signal
+from core import chat, llm
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    llm.open_http_client(chat.COMPLETION_TIMEOUT_SECONDS)
+    chat.start_ai_worker(standalone=True)
+    print(f"AI worker running, {chat.AI_WORKER_CONCURRENCY} concurrent replies")
+    try:
+        await stop.wait()
+    finally:
+        print("AI worker draining")
+        await chat.stop_ai_worker()
+        await chat.stop_room_tasks()
+        await llm.close_http_client()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())